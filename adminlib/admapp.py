@@ -2,6 +2,7 @@ import time
 import os, os.path
 import threading
 import sqlite3
+from contextlib import contextmanager
 
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 
@@ -9,11 +10,12 @@ from tinyapp.app import TinyApp, TinyRequest
 from tinyapp.handler import ReqHandler
 import tinyapp.auth
 
-from adminlib.session import find_user
-from adminlib.info import formatdate
+from adminlib.session import find_user, SessionCache
+from adminlib.info import formatdate, DirScanCache, SymlinkResolver
 from adminlib.util import find_unused_filename
 from adminlib.jenv import DelimNumber, PrettyBytes, Pluralize, AttrList, SplitURI, AllLatin1
-from adminlib.hasher import Hasher
+from adminlib.hasher import Hasher, Prehasher
+from adminlib.index import IndexCache
 
 class AdminApp(TinyApp):
     """AdminApp: The TinyApp class.
@@ -53,6 +55,12 @@ class AdminApp(TinyApp):
         self.max_trash_age = config['AdminTool'].getint('MaxTrashAge')
 
         self.db_path = config['DEFAULT']['DBFile']
+        self.db_journal_mode = config['AdminTool'].get('DBJournalMode', 'WAL')
+        self.db_busy_timeout = config['AdminTool'].getint('DBBusyTimeout', 5000)
+        self.db_synchronous = config['AdminTool'].get('DBSynchronous', 'NORMAL')
+        self.db_cache_size = config['AdminTool'].getint('DBCacheSize', None)
+        self.db_mmap_size = config['AdminTool'].getint('DBMmapSize', None)
+        self.db_cached_statements = config['AdminTool'].getint('DBCachedStatements', 256)
         self.build_script_path = config['AdminTool']['BuildScriptFile']
         self.build_lock_path = config['AdminTool']['BuildLockFile']
         self.build_output_path = config['AdminTool']['BuildOutputFile']
@@ -61,11 +69,68 @@ class AdminApp(TinyApp):
         self.log_file_path = config['AdminTool']['LogFile']
         self.app_css_uri = config['AdminTool']['AppCSSURI']
 
+        # Short-lived cache of login sessions, so that find_user() doesn't
+        # need the database on every request. It is thread-safe.
+        self.sessioncache = SessionCache(
+            ttl=config['AdminTool'].getint('SessionCacheTime', 60))
+
+        # Cache of resolved symlinks, for all directory listings. It is
+        # thread-safe.
+        self.linkresolver = SymlinkResolver(
+            self.archive_dir,
+            maxentries=config['AdminTool'].getint('LinkCacheMaxEntries', 5000))
+
+        # Cache of raw directory scans, for Archive directory listings.
+        # It is thread-safe.
+        self.dircache = DirScanCache(
+            maxentries=config['AdminTool'].getint('DirCacheMaxEntries', 200),
+            maxage=config['AdminTool'].getint('DirCacheMaxAge', 300),
+            resolver=self.linkresolver)
+
+        # Cache of parsed Index files. It is thread-safe.
+        self.indexcache = IndexCache(
+            maxbytes=config['AdminTool'].getint('IndexCacheMaxBytes', 8388608))
+
         # Thread-local storage for various things which are not thread-safe.
         self.threadcache = threading.local()
 
         # Module for computing (and caching) MD5 checksums. It is thread-safe.
-        self.hasher = Hasher()
+        # If HashCacheFile is set, the cache is also kept on disk and
+        # shared between processes.
+        self.hasher = Hasher(
+            maxentries=config['AdminTool'].getint('HashCacheMaxEntries', 10000),
+            maxbytes=config['AdminTool'].getint('HashCacheMaxBytes', None),
+            threads=config['AdminTool'].getint('HashThreads', 4),
+            digests=config['AdminTool'].get('HashDigests', 'md5').replace(',', ' ').split(),
+            dbpath=config['AdminTool'].get('HashCacheFile'))
+
+        # Background worker which keeps the hasher warm for /incoming
+        # and /unprocessed. This doesn't start until start_background()
+        # is called (and not at all if PrehashInterval is zero).
+        # With a shared HashCacheFile, the server processes take turns
+        # (via a lock file) and share the results. Without one, each
+        # process has its own cache, so each one has to prehash for
+        # itself.
+        self.prehasher = None
+        val = config['AdminTool'].getint('PrehashInterval', 0)
+        if val:
+            lockpath = None
+            if self.hasher.dbpath:
+                lockpath = self.hasher.dbpath+'.prehash-lock'
+            self.prehasher = Prehasher(
+                self.hasher,
+                [ self.incoming_dir, self.unprocessed_dir ],
+                interval=val,
+                threads=config['AdminTool'].getint('PrehashThreads', 2),
+                budget=config['AdminTool'].getint('PrehashBudget', None),
+                lockpath=lockpath)
+
+    def start_background(self):
+        """Start any background threads. We only do this in the web
+        server, not for command-line runs.
+        """
+        if self.prehasher:
+            self.prehasher.start()
 
     def getdb(self):
         """Get or create a sqlite3 db connection object. These are
@@ -76,11 +141,61 @@ class AdminApp(TinyApp):
         """
         db = getattr(self.threadcache, 'db', None)
         if db is None:
-            db = sqlite3.connect(self.db_path)
+            db = sqlite3.connect(
+                self.db_path,
+                timeout=self.db_busy_timeout / 1000,
+                cached_statements=self.db_cached_statements)
             db.isolation_level = None   # autocommit
+            self.setup_db(db)
             self.threadcache.db = db
         return db
 
+    def setup_db(self, db):
+        """Apply the connection settings from the config file.
+        WAL mode lets readers carry on while someone else is writing,
+        so page loads don't trip over the cleanup cron job. (It's a
+        property of the database file, so it sticks once set. The
+        directory containing the database must be writable, because
+        SQLite creates -wal and -shm files next to it.)
+        """
+        if self.db_journal_mode:
+            db.execute('PRAGMA journal_mode = %s' % (self.db_journal_mode,))
+        if self.db_synchronous:
+            db.execute('PRAGMA synchronous = %s' % (self.db_synchronous,))
+        db.execute('PRAGMA busy_timeout = %d' % (self.db_busy_timeout,))
+        if self.db_cache_size is not None:
+            db.execute('PRAGMA cache_size = %d' % (self.db_cache_size,))
+        if self.db_mmap_size is not None:
+            db.execute('PRAGMA mmap_size = %d' % (self.db_mmap_size,))
+
+    @contextmanager
+    def transaction(self):
+        """Context manager which wraps a group of writes in a single
+        transaction:
+
+            with app.transaction() as curs:
+                curs.execute(...)
+                curs.execute(...)
+
+        The writes are committed together when the block exits, or
+        rolled back if it raises an exception. We use BEGIN IMMEDIATE,
+        which takes the write lock up front (waiting up to the busy
+        timeout) rather than failing halfway through.
+        Nested calls join the outer transaction.
+        """
+        db = self.getdb()
+        curs = db.cursor()
+        if db.in_transaction:
+            yield curs
+            return
+        curs.execute('BEGIN IMMEDIATE')
+        try:
+            yield curs
+        except:
+            curs.execute('ROLLBACK')
+            raise
+        curs.execute('COMMIT')
+
     def getjenv(self):
         """Get or create a jinja template environment. These are
         cached per-thread.
@@ -183,11 +298,18 @@ class AdminApp(TinyApp):
         else:
             # Write out the updated Index.
             indexdir.write()
+
+        # Rewriting Index in place doesn't change the directory mtime.
+        # (Invalidate after the write, so that a concurrent request
+        # can't re-cache the old contents.)
+        self.dircache.invalidate(os.path.dirname(indexdir.indexpath))
+        self.indexcache.invalidate(indexdir.indexpath)
         
 
 class AdminRequest(TinyRequest):
     """Our app-specific subclass of TinyRequest. This just has a spot
-    to stash the current User (as determined by the find_user() filter).
+    to stash the current User (as determined by the find_user() filter),
+    and a few per-request memos.
     """
     
     def __init__(self, app, env):
@@ -195,6 +317,8 @@ class AdminRequest(TinyRequest):
 
         # Initialize our app-specific fields.
         self._user = None
+        # Symlinks resolved during this request (see get_linkmemo()).
+        self._linkmemo = None
 
     def lognote(self):
         """A string which will appear in any log line generated by this
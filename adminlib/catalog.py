@@ -0,0 +1,156 @@
+import os, os.path
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from adminlib.hasher import digest_file
+from adminlib.util import sql_chunks
+
+# The catalog is a table of every file in the Archive: its path (relative
+# to the Archive root), size, mtime (in nanoseconds), and md5. We use it
+# to spot uploads which are identical to something already in the
+# Archive.
+#
+# It's kept up to date by the "catalog" CLI command (which should run
+# from cron). Each run walks the whole tree, but only re-hashes files
+# whose size or mtime has changed.
+
+# How many files to hash (and write to the database) per transaction.
+# An interrupted run keeps the work it's committed.
+CATALOG_BATCH = 200
+
+def walk_archive(archivedir, exclude=None, threads=4):
+    """Walk the Archive tree, scanning directories in parallel.
+    Returns (found, baddirs). found is a dict mapping each file's path
+    (relative to archivedir) to (size, mtime_ns); baddirs is a list of
+    directories that couldn't be read.
+    Symlinks are neither followed nor listed. Directories in exclude
+    (full paths) are skipped, as is lost+found.
+    """
+    exclude = set(exclude or [])
+
+    def scan(dirpath):
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(dirpath) as entries:
+                for ent in entries:
+                    if ent.is_symlink():
+                        continue
+                    if ent.is_dir():
+                        if ent.name != 'lost+found' and ent.path not in exclude:
+                            subdirs.append(ent.path)
+                    elif ent.is_file():
+                        stat = ent.stat()
+                        files.append( (ent.path, stat.st_size, stat.st_mtime_ns) )
+        except OSError:
+            return (dirpath, None, None)
+        return (dirpath, files, subdirs)
+
+    found = {}
+    baddirs = []
+    prefixlen = len(archivedir)+1
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='catalog') as executor:
+        pending = set([ executor.submit(scan, archivedir) ])
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dirpath, files, subdirs = future.result()
+                if files is None:
+                    baddirs.append(dirpath)
+                    continue
+                for pathname, size, mtime in files:
+                    found[pathname[prefixlen:]] = (size, mtime)
+                for subdir in subdirs:
+                    pending.add(executor.submit(scan, subdir))
+    return found, baddirs
+
+def hash_file(pathname, size):
+    """Return the md5 of a file, or None if it can't be read.
+    (We don't go through the app's Hasher; there's no point in
+    filling its cache with every file in the Archive.)
+    """
+    hasher = hashlib.md5()
+    try:
+        if size > 0:
+            digest_file([hasher], pathname, size)
+    except OSError:
+        return None
+    return hasher.hexdigest()
+
+def update_catalog(app, threads=4, rehash=False, log=print):
+    """Bring the catalog table up to date with the Archive. New and
+    changed files are hashed (in parallel); files that have vanished
+    are removed. If rehash is set, every file is hashed.
+    The unprocessed directory is not cataloged; its files aren't
+    really in the Archive yet.
+    Returns a dict of counts.
+    """
+    archivedir = app.archive_dir
+    curs = app.getdb().cursor()
+    known = {}
+    res = curs.execute('SELECT path, size, mtime FROM catalog')
+    for path, size, mtime in res.fetchall():
+        known[path] = (size, mtime)
+
+    found, baddirs = walk_archive(archivedir, exclude=[ app.unprocessed_dir ], threads=threads)
+    for dirpath in baddirs:
+        log('unable to read directory: %s' % (dirpath,))
+
+    # If a directory couldn't be read, we don't know whether its files
+    # are gone, so we leave their entries alone.
+    badprefixes = tuple([ dirpath[ len(archivedir)+1 : ]+'/' for dirpath in baddirs ])
+    removed = [ path for path in known if path not in found and not (badprefixes and path.startswith(badprefixes)) ]
+    changed = [ path for path, val in found.items() if rehash or known.get(path) != val ]
+    changed.sort()
+    log('%d files found, %d new or changed, %d removed' % (len(found), len(changed), len(removed),))
+
+    if removed:
+        with app.transaction() as curs:
+            curs.executemany('DELETE FROM catalog WHERE path = ?', [ (path,) for path in removed ])
+
+    stats = {
+        'files': len(found),
+        'changed': len(changed),
+        'removed': len(removed),
+        'hashed': 0,
+        'bytes': 0,
+        'failed': 0,
+    }
+    if not changed:
+        return stats
+
+    def work(path):
+        size, mtime = found[path]
+        return hash_file(os.path.join(archivedir, path), size)
+
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='catalog') as executor:
+        for pos in range(0, len(changed), CATALOG_BATCH):
+            chunk = changed[ pos : pos+CATALOG_BATCH ]
+            rows = []
+            for path, md5 in zip(chunk, executor.map(work, chunk)):
+                if md5 is None:
+                    stats['failed'] += 1
+                    log('unable to read file: %s' % (path,))
+                    continue
+                size, mtime = found[path]
+                rows.append( (path, size, mtime, md5) )
+                stats['hashed'] += 1
+                stats['bytes'] += size
+            with app.transaction() as curs:
+                curs.executemany('INSERT OR REPLACE INTO catalog (path, size, mtime, md5) VALUES (?, ?, ?, ?)', rows)
+            log('hashed %d of %d files' % (min(pos+CATALOG_BATCH, len(changed)), len(changed),))
+    return stats
+
+def find_identical(db, md5s):
+    """Return a dict mapping md5 checksums to lists of catalog paths
+    (sorted). Checksums with no matches are omitted.
+    """
+    md5s = [ val for val in md5s if val ]
+    res = {}
+    curs = db.cursor()
+    for chunk, marks in sql_chunks(md5s):
+        for path, md5 in curs.execute('SELECT path, md5 FROM catalog WHERE md5 IN (%s)' % (marks,), chunk).fetchall():
+            res.setdefault(md5, []).append(path)
+    for ls in res.values():
+        ls.sort()
+    return res
@@ -1,10 +1,23 @@
+import sys
 import argparse
+import csv
+import json
 import os, os.path
 import time
 import hashlib
 import logging
+import tempfile
+import tracemalloc
 
 from tinyapp.util import random_bytes, time_now
+import adminlib.hasher
+import adminlib.info
+import adminlib.session
+import adminlib.util
+from adminlib.schema import table_columns
+import adminlib.schema
+import adminlib.export
+import adminlib.catalog
 
 def run(appinstance):
     """The entry point when admin.wsgi is invoked on the command line.
@@ -31,9 +44,14 @@ def run(appinstance):
     popt_createdb = subopt.add_parser('createdb', help='create database tables')
     popt_createdb.set_defaults(cmdfunc=cmd_createdb)
     
+    popt_migrate = subopt.add_parser('migrate', help='bring database tables up to date')
+    popt_migrate.set_defaults(cmdfunc=cmd_migrate)
+    popt_migrate.add_argument('--check', action='store_true', help='show query plans for common queries')
+    
     popt_addupload = subopt.add_parser('addupload', help='add a file to the upload log')
     popt_addupload.set_defaults(cmdfunc=cmd_addupload)
-    popt_addupload.add_argument('file')
+    popt_addupload.add_argument('file', help='(with --batch: a .jsonl or .csv manifest, or a directory)')
+    popt_addupload.add_argument('--batch', action='store_true', help='add many files at once')
     popt_addupload.add_argument('--name')
     popt_addupload.add_argument('--email')
     popt_addupload.add_argument('--tempid')
@@ -42,6 +60,33 @@ def run(appinstance):
     popt_addupload.add_argument('--dir')
     popt_addupload.add_argument('-m', '--message')
     
+    popt_export = subopt.add_parser('export', help='export the upload log')
+    popt_export.set_defaults(cmdfunc=cmd_export)
+    popt_export.add_argument('--format', choices=adminlib.export.EXPORT_FORMATS, default='csv')
+    popt_export.add_argument('--from', dest='datefrom', metavar='YYYY-MM-DD')
+    popt_export.add_argument('--to', dest='dateto', metavar='YYYY-MM-DD')
+    popt_export.add_argument('--md5')
+    popt_export.add_argument('--donor', help='uploader name or email')
+    popt_export.add_argument('-o', '--output', metavar='FILE', help='(default: stdout)')
+    
+    popt_catalog = subopt.add_parser('catalog', help='update the catalog of archive files')
+    popt_catalog.set_defaults(cmdfunc=cmd_catalog)
+    popt_catalog.add_argument('--threads', type=int, default=4)
+    popt_catalog.add_argument('--rehash', action='store_true', help='hash every file, not just new and changed ones')
+    popt_catalog.add_argument('-q', '--quiet', action='store_true')
+    
+    popt_benchhash = subopt.add_parser('benchhash', help='compare file hashing strategies')
+    popt_benchhash.set_defaults(cmdfunc=cmd_benchhash)
+    popt_benchhash.add_argument('file', nargs='+')
+    popt_benchhash.add_argument('--repeat', type=int, default=3)
+    
+    popt_benchlist = subopt.add_parser('benchlist', help='time building a directory listing')
+    popt_benchlist.set_defaults(cmdfunc=cmd_benchlist)
+    popt_benchlist.add_argument('dir', nargs='?', help='(default: a temporary directory of --count files)')
+    popt_benchlist.add_argument('--count', type=int, default=5000)
+    popt_benchlist.add_argument('--repeat', type=int, default=3)
+    popt_benchlist.add_argument('--tz', default='America/New_York', help='timezone to format dates in')
+    
     popt_test = subopt.add_parser('test', help='print page to stdout')
     popt_test.set_defaults(cmdfunc=cmd_test)
     popt_test.add_argument('uri', nargs='?', default='', metavar='URI')
@@ -72,6 +117,167 @@ def cmd_test(args, app):
     app.test_dump(args.uri)
     
     
+def cmd_export(args, app):
+    """Export the upload log as CSV or JSON Lines. Dates are UTC.
+    """
+    try:
+        query, qargs = adminlib.export.export_query(
+            datefrom=args.datefrom, dateto=args.dateto,
+            md5=args.md5, donor=args.donor)
+        outiter = adminlib.export.export_text(app.getdb(), query, qargs, format=args.format)
+    except adminlib.export.ExportError as ex:
+        print(ex)
+        return
+    if args.output:
+        outfl = open(args.output, 'w', encoding='utf-8', newline='')
+    else:
+        outfl = sys.stdout
+    for val in outiter:
+        outfl.write(val)
+    if args.output:
+        outfl.close()
+
+def cmd_catalog(args, app):
+    """Update the catalog of files in the Archive (for spotting
+    duplicate uploads). Only new and changed files are hashed.
+    """
+    if args.quiet:
+        log = lambda msg: None
+    else:
+        log = print
+    if 'catalog' not in adminlib.schema.table_names(app.getdb().cursor()):
+        print('the database has no catalog table; run "migrate" first')
+        return
+    starttime = time.time()
+    stats = adminlib.catalog.update_catalog(app, threads=args.threads, rehash=args.rehash, log=log)
+    elapsed = time.time() - starttime
+    logging.info('CLI user=%s: catalog: %d files, %d hashed, %d removed', get_curuser(), stats['files'], stats['hashed'], stats['removed'])
+    log('%d files hashed (%d bytes), %d removed, %d failed, in %.1f sec' % (stats['hashed'], stats['bytes'], stats['removed'], stats['failed'], elapsed,))
+
+def cmd_benchhash(args, app):
+    """Time the md5 strategies in adminlib.hasher on some files, and
+    compare them to the old 16 kB read() loop. Prints MB/s for each.
+    (Each file is read once first, so this measures warm-cache speed.
+    That's what we're comparing; the disk is the disk.)
+    """
+    def legacy(hasher, pathname, size):
+        fl = open(pathname, 'rb')
+        while True:
+            dat = fl.read(16384)
+            if not dat:
+                break
+            hasher.update(dat)
+        fl.close()
+
+    strategies = [ ('legacy', legacy) ]
+    for strategy in ('readinto', 'filedigest', 'mmap'):
+        if strategy == 'filedigest' and not hasattr(hashlib, 'file_digest'):
+            continue
+        func = lambda hasher, pathname, size, strategy=strategy: adminlib.hasher.digest_file([hasher], pathname, size, strategy=strategy)
+        strategies.append( (strategy, func) )
+    
+    for pathname in args.file:
+        size = os.stat(pathname).st_size
+        if not size:
+            print('%s: empty file, skipping' % (pathname,))
+            continue
+        print('%s: %d bytes' % (pathname, size,))
+        legacy(hashlib.md5(), pathname, size)
+        for name, func in strategies:
+            best = None
+            for ix in range(args.repeat):
+                hasher = hashlib.md5()
+                starttime = time.perf_counter()
+                func(hasher, pathname, size)
+                elapsed = time.perf_counter() - starttime
+                if best is None or elapsed < best:
+                    best = elapsed
+            rate = size / max(best, 1e-9) / 1000000
+            print('  %-10s %9.1f MB/s  %s' % (name, rate, hasher.hexdigest(),))
+    
+def cmd_benchlist(args, app):
+    """Time the steps of building a directory listing, per entry: the
+    scan, creating the ListEntries, and formatting their dates. Also
+    measure the memory used by the ListEntries. The date
+    formatting is compared to the old way (convert and strftime every
+    row, whether the template shows it or not).
+    Without a directory argument, we make a temporary one with --count
+    files whose dates are spread over a few years.
+    """
+    user = adminlib.session.User('bench', None, roles='', tzname=args.tz)
+    
+    def legacy(ls):
+        for ent in ls:
+            dat = adminlib.util.in_user_time(user, ent.date)
+            dat.strftime('%b %d, %Y')
+
+    def entries(ls):
+        pass
+    
+    def fdates(ls):
+        for ent in ls:
+            ent.fdate
+
+    def coldfdates(ls):
+        adminlib.util.clear_date_caches()
+        fdates(ls)
+
+    def run(dirpath):
+        records = adminlib.info.scan_dir(dirpath, app.archive_dir)
+        count = len(records)
+        if not count:
+            print('%s: no entries' % (dirpath,))
+            return
+        print('%s: %d entries' % (dirpath, count,))
+        
+        best = None
+        for ix in range(args.repeat):
+            starttime = time.perf_counter()
+            adminlib.info.scan_dir(dirpath, app.archive_dir)
+            elapsed = time.perf_counter() - starttime
+            if best is None or elapsed < best:
+                best = elapsed
+        print('  %-22s %8.2f us/entry' % ('scan', best / count * 1000000,))
+
+        steps = [
+            ('entries (no dates)', entries),
+            ('entries + old dates', legacy),
+            ('entries + fdate, cold', coldfdates),
+            ('entries + fdate, warm', fdates),
+        ]
+        for name, func in steps:
+            best = None
+            for ix in range(args.repeat):
+                starttime = time.perf_counter()
+                ls = [ adminlib.info.make_list_entry(rec, dirs=True, user=user) for rec in records ]
+                func(ls)
+                elapsed = time.perf_counter() - starttime
+                if best is None or elapsed < best:
+                    best = elapsed
+            print('  %-22s %8.2f us/entry' % (name, best / count * 1000000,))
+
+        # Memory held by the entries (not counting the scan records).
+        tracemalloc.start()
+        ls = [ adminlib.info.make_list_entry(rec, dirs=True, user=user) for rec in records ]
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('  %-22s %8.0f bytes/entry' % ('entry memory', size / count,))
+
+    if args.dir:
+        run(args.dir)
+        return
+    
+    with tempfile.TemporaryDirectory() as dirpath:
+        # One file every six hours, going back from now, with an
+        # assortment of extensions.
+        exts = [ 'z5', 'zip', 'txt', 'html', 'tar.gz', 'gblorb', 'pdf', 't3' ]
+        now = int(time.time())
+        for ix in range(args.count):
+            pathname = os.path.join(dirpath, 'file%05d.%s' % (ix, exts[ix % len(exts)],))
+            open(pathname, 'w').close()
+            os.utime(pathname, (now - ix*21600, now - ix*21600))
+        run(dirpath)
+    
 def cmd_cleanup(args, app):
     """Clean up stuff that needs to be cleaned up periodically.
     Should be run from a cron job.
@@ -105,34 +311,58 @@ def cmd_cleanup(args, app):
         pathname = os.path.join(app.trash_dir, name)
         os.remove(pathname)
 
+    # Clean out old entries in the on-disk hash cache (if there is one).
+    count = app.hasher.expire_stored()
+    if count:
+        print('Expired %d hash cache entries' % (count,))
+
 def cmd_createdb(args, app):
-    """Create the database tables. This only needs to be done once ever,
-    unless of course we change the table structure or decide to wipe
-    and start over.
-    TODO: Add a column if it doesn't exist?
+    """Create the database tables. This only needs to be done once ever.
+    If the table structure changes, run "migrate" (which is really the
+    same thing).
     """
     logging.info('CLI user=%s: createdb', get_curuser())
-    curs = app.getdb().cursor()
-    res = curs.execute('SELECT name FROM sqlite_master')
-    tables = [ tup[0] for tup in res.fetchall() ]
-    
-    if 'users' in tables:
-        print('"users" table exists')
-    else:
-        print('creating "users" table...')
-        curs.execute('CREATE TABLE users(name unique, email unique, pw, pwsalt, roles, tzname)')
+    applied = adminlib.schema.migrate(app.getdb())
+    if not applied:
+        print('database is up to date (version %d)' % (adminlib.schema.latest_version(),))
 
-    if 'sessions' in tables:
-        print('"sessions" table exists')
-    else:
-        print('creating "sessions" table...')
-        curs.execute('CREATE TABLE sessions(name, sessionid unique, ipaddr, starttime, refreshtime)')
+def cmd_migrate(args, app):
+    """Apply any schema migrations which haven't yet been applied to
+    the database. With --check, also show how SQLite plans the queries
+    that we run most often, and flag any that don't use an index.
+    """
+    curs = app.getdb().cursor()
+    if not args.check:
+        logging.info('CLI user=%s: migrate', get_curuser())
+        oldversion = adminlib.schema.schema_version(curs)
+        applied = adminlib.schema.migrate(app.getdb())
+        if not applied:
+            print('database is up to date (version %d)' % (oldversion,))
+        else:
+            print('database migrated from version %d to %d' % (oldversion, applied[-1],))
+        return
 
-    if 'uploads' in tables:
-        print('"uploads" table exists')
+    version = adminlib.schema.schema_version(curs)
+    latest = adminlib.schema.latest_version()
+    if version < latest:
+        print('database is at version %d; run "migrate" to reach version %d' % (version, latest,))
     else:
-        print('creating "uploads" table...')
-        curs.execute('CREATE TABLE uploads(uploadtime, md5, size, filename, origfilename, donorname, donoremail, donorip, donoruseragent, permission, suggestdir, ifdbid, about, usernotes, tuid)')
+        print('database is up to date (version %d)' % (version,))
+    tables = adminlib.schema.table_names(curs)
+    badcount = 0
+    for (table, query, qargs) in adminlib.schema.HOT_QUERIES:
+        if table not in tables:
+            print('skip %s' % (query,))
+            print('       (table "%s" not migrated)' % (table,))
+            continue
+        lines, bad = adminlib.schema.explain_query(curs, query, qargs)
+        if bad:
+            badcount += 1
+        print('%s %s' % ('SLOW' if bad else 'ok  ', query,))
+        for line in lines:
+            print('       %s' % (line,))
+    if badcount:
+        print('%d queries do not use an index' % (badcount,))
 
 
 def cmd_adduser(args, app):
@@ -175,21 +405,136 @@ def cmd_edituser(args, app):
         print('changing pw for user "%s"...' % (args.name,))
         logging.info('CLI user=%s: edituser %s, pw=...', get_curuser(), args.name)
         # Log out all sessions for the old pw
-        curs.execute('DELETE FROM sessions WHERE name = ?', (args.name,))
-        curs.execute('UPDATE users SET pw = ?, pwsalt = ? WHERE name = ?', (crypted, pwsalt, args.name))
+        with app.transaction() as curs:
+            curs.execute('DELETE FROM sessions WHERE name = ?', (args.name,))
+            curs.execute('UPDATE users SET pw = ?, pwsalt = ? WHERE name = ?', (crypted, pwsalt, args.name))
 
 
 def cmd_addupload(args, app):
     """Create a new upload record.
     """
+    if args.batch:
+        addupload_batch(args, app)
+        return
     filename = args.file
-    md5, size = app.hasher.get_md5_size(filename)
+    # This computes md5 and (if configured) sha256 in the same pass.
+    digests, size = app.hasher.get_digests(filename)
     barefilename = os.path.basename(filename)
     origfile = args.origfile or barefilename
     now = time_now()
     print('adding upload record for %s...' % (filename,))
     logging.info('CLI user=%s: addupload %s', get_curuser(), filename)
-    curs = app.getdb().cursor()
-    curs.execute('INSERT INTO uploads (uploadtime, md5, size, filename, origfilename, donorname, donoremail, permission, suggestdir, ifdbid, about, tuid) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (now, md5, size, barefilename, origfile, args.name, args.email, 'cli', args.dir, args.tempid, args.message, args.tuid))
+    row = (now, digests['md5'], size, barefilename, origfile, args.name, args.email, 'cli', args.dir, args.tempid, args.message, args.tuid, digests.get('sha256'))
+    insert_uploads(app, [ row ])
+
+# Manifest fields for "addupload --batch", with the addupload options
+# they correspond to. Only "file" is required. Options given on the
+# command line are defaults for every row.
+BATCH_FIELDS = [ 'file', 'name', 'email', 'tempid', 'tuid', 'origfile', 'dir', 'message' ]
+
+def addupload_batch(args, app):
+    """Create upload records for many files at once. The source
+    (args.file) is a JSON Lines or CSV manifest, or a directory (in
+    which case every regular file in it is added, with the options
+    from the command line).
+    The files are hashed in parallel, and the records are inserted in
+    a single transaction; if anything goes wrong, nothing is added.
+    """
+    source = args.file
+    defaults = dict([ (key, getattr(args, key)) for key in BATCH_FIELDS if key != 'file' ])
+    try:
+        entries = read_batch_source(source, defaults)
+    except Exception as ex:
+        print('unable to read %s: %s' % (source, ex,))
+        return
+    if not entries:
+        print('no files found in %s' % (source,))
+        return
+    
+    total = len(entries)
+    print('hashing %d files...' % (total,))
+    starttime = time.time()
+    state = { 'count':0, 'bytes':0, 'lastreport':starttime }
+    def progress(pathname, val):
+        state['count'] += 1
+        if val:
+            state['bytes'] += val[1]
+        now = time.time()
+        if now - state['lastreport'] >= 1 or state['count'] == total:
+            state['lastreport'] = now
+            elapsed = max(now - starttime, 1e-9)
+            print('  %d/%d files, %.1f MB, %.1f files/s, %.1f MB/s' % (state['count'], total, state['bytes'] / 1000000, state['count'] / elapsed, state['bytes'] / elapsed / 1000000,))
+    
+    pathnames = [ ent['file'] for ent in entries ]
+    results = app.hasher.get_digests_many(pathnames, progress=progress)
+    hashtime = time.time() - starttime
+
+    now = time_now()
+    rows = []
+    skipped = 0
+    for ent in entries:
+        val = results.get(ent['file'])
+        if not val:
+            print('skipping unreadable file: %s' % (ent['file'],))
+            skipped += 1
+            continue
+        digests, size = val
+        barefilename = os.path.basename(ent['file'])
+        origfile = ent['origfile'] or barefilename
+        rows.append( (now, digests['md5'], size, barefilename, origfile, ent['name'], ent['email'], 'cli', ent['dir'], ent['tempid'], ent['message'], ent['tuid'], digests.get('sha256')) )
+    if not rows:
+        print('nothing to add')
+        return
+
+    starttime = time.time()
+    logging.info('CLI user=%s: addupload --batch %s (%d files)', get_curuser(), source, len(rows))
+    insert_uploads(app, rows)
+    inserttime = time.time() - starttime
+    print('added %d upload records (%d skipped); hashing took %.2f sec, inserting took %.3f sec' % (len(rows), skipped, hashtime, inserttime,))
+
+def read_batch_source(source, defaults):
+    """Read the list of files for "addupload --batch". Returns a list of
+    dicts with all the BATCH_FIELDS keys. Relative filenames in a
+    manifest are relative to the manifest's directory.
+    """
+    if os.path.isdir(source):
+        ls = []
+        for ent in os.scandir(source):
+            if ent.is_file() and not ent.name.startswith('.'):
+                ls.append({ 'file':ent.path })
+        ls.sort(key=lambda map: map['file'])
+    else:
+        basedir = os.path.dirname(source)
+        fl = open(source, encoding='utf-8', newline='')
+        if source.lower().endswith('.csv'):
+            ls = list(csv.DictReader(fl))
+        else:
+            ls = [ json.loads(ln) for ln in fl if ln.strip() ]
+        fl.close()
+        for map in ls:
+            if not map.get('file'):
+                raise Exception('manifest entry has no "file": %s' % (map,))
+            map['file'] = os.path.join(basedir, map['file'])
+    
+    res = []
+    for map in ls:
+        ent = dict(defaults)
+        for key in BATCH_FIELDS:
+            if map.get(key):
+                ent[key] = map[key]
+        res.append(ent)
+    return res
+
+def insert_uploads(app, rows):
+    """Insert upload records created by the CLI, all in one transaction.
+    Each row is (uploadtime, md5, size, filename, origfilename, donorname,
+    donoremail, permission, suggestdir, ifdbid, about, tuid, sha256).
+    """
+    with app.transaction() as curs:
+        if 'sha256' in table_columns(curs, 'uploads'):
+            curs.executemany('INSERT INTO uploads (uploadtime, md5, size, filename, origfilename, donorname, donoremail, permission, suggestdir, ifdbid, about, tuid, sha256) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        else:
+            # Old table (migrate hasn't added the column yet).
+            curs.executemany('INSERT INTO uploads (uploadtime, md5, size, filename, origfilename, donorname, donoremail, permission, suggestdir, ifdbid, about, tuid) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [ row[:-1] for row in rows ])
     
     
@@ -0,0 +1,102 @@
+import io
+import csv
+import json
+
+from adminlib.util import user_date_to_timestamp
+
+# Export the upload log in bulk. This is used by both the /uploadlog/export
+# page and the "export" CLI command.
+#
+# The rows are streamed out of SQLite in batches, so memory use doesn't
+# depend on the size of the log. (With the database in WAL mode, a long
+# export doesn't block anybody else from writing.)
+
+EXPORT_FORMATS = [ 'csv', 'jsonl' ]
+
+# How many rows to pull from the cursor (and send out) at a time.
+EXPORT_BATCH = 500
+
+class ExportError(Exception):
+    """Raised for bad export parameters.
+    """
+    pass
+
+def export_query(datefrom=None, dateto=None, md5=None, donor=None, user=None):
+    """Build the SQL query (and arguments) for an export. Dates are
+    "YYYY-MM-DD" strings, interpreted in the user's timezone (or UTC);
+    both ends are inclusive. The donor can be a name or email address,
+    case-insensitive.
+    Raises ExportError if a date is malformed.
+    """
+    clauses = []
+    args = []
+    try:
+        if datefrom:
+            clauses.append('uploadtime >= ?')
+            args.append(user_date_to_timestamp(user, datefrom))
+        if dateto:
+            clauses.append('uploadtime < ?')
+            args.append(user_date_to_timestamp(user, dateto, nextday=True))
+    except ValueError:
+        raise ExportError('Dates look like YYYY-MM-DD.')
+    if md5:
+        clauses.append('md5 = ?')
+        args.append(md5.strip().lower())
+    if donor:
+        clauses.append('(donorname = ? COLLATE NOCASE OR donoremail = ? COLLATE NOCASE)')
+        args.append(donor.strip())
+        args.append(donor.strip())
+
+    query = 'SELECT * FROM uploads'
+    if clauses:
+        query += ' WHERE ' + ' AND '.join(clauses)
+    query += ' ORDER BY uploadtime, rowid'
+    return (query, args)
+
+def export_rows(db, query, args):
+    """Generate (columns, rows) batches for a query. The column list is
+    the same every time.
+    """
+    curs = db.cursor()
+    try:
+        curs.execute(query, args)
+        columns = [ tup[0] for tup in curs.description ]
+        while True:
+            rows = curs.fetchmany(EXPORT_BATCH)
+            if not rows:
+                break
+            yield (columns, rows)
+    finally:
+        curs.close()
+
+def export_text(db, query, args, format='csv'):
+    """Return an iterator of strings, one per batch of rows. CSV output
+    begins with a header line; JSON Lines output has one object per row.
+    Raises ExportError (right away, not when iterating) if the format
+    is unknown.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ExportError('Unknown format: %s' % (format,))
+    return export_text_gen(db, query, args, format)
+
+def export_text_gen(db, query, args, format):
+    started = False
+    for columns, rows in export_rows(db, query, args):
+        outfl = io.StringIO()
+        if format == 'csv':
+            writer = csv.writer(outfl)
+            if not started:
+                writer.writerow(columns)
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                outfl.write(json.dumps(dict(zip(columns, row))))
+                outfl.write('\n')
+        started = True
+        yield outfl.getvalue()
+    if not started and format == 'csv':
+        # No rows; we still want the header line.
+        res = db.execute(query+' LIMIT 0', args)
+        outfl = io.StringIO()
+        csv.writer(outfl).writerow([ tup[0] for tup in res.description ])
+        yield outfl.getvalue()
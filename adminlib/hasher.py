@@ -1,29 +1,126 @@
 import os
 import time
+import mmap
 import hashlib
 import threading
 import logging
+import fcntl
+import sqlite3
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 class Hasher:
     """In the course of the admintool, we do a lot of md5 hashing of files.
     (The md5 is a database key.) We may have to check this hash every
     request. This can be expensive for large files.
 
-    It is pretty safe to instead track files by (pathname, filesize, modtime).
-    If all of those are the same, the file hasn't changed. So we're going
-    to keep an (in-memory) cache mapping that tuple to md5.
+    It is pretty safe to instead track files by (device, inode, filesize,
+    modtime). If all of those are the same, the file hasn't changed. So
+    we're going to keep an (in-memory) cache mapping that tuple to md5.
+    (We don't use the pathname in the key, so renaming a file, or moving
+    it within a filesystem, doesn't lose its hash. For moves between
+    filesystems, call moved() afterwards.)
+
+    If dbpath is supplied, we also keep the same mapping in an SQLite
+    file. This is shared by every process (all the Apache daemons, plus
+    command-line runs), so a hash computed once survives restarts. The
+    in-memory map is checked first; the file is only consulted on a
+    memory miss.
+
+    The in-memory map is kept in least-recently-used order, so expiring
+    old entries only ever looks at the front of it. We also cap the number
+    of entries (maxentries) and, optionally, the total size of the files
+    they represent (maxbytes).
+
+    get_md5_many() and get_digests_many() hash a list of files on a
+    bounded pool of worker threads. (hashlib releases the GIL, so this really is parallel.)
+
+    We always compute md5, but the digests argument can ask for more
+    (e.g. ('md5', 'sha256')). All of them are computed in the same pass
+    over the file and cached together. get_digests() returns the lot.
+
+    If several threads ask for the same file at the same time, only the
+    first one reads it. The rest wait for its result.
+
+    We keep counters of what the cache is doing (hits, misses, bytes
+    hashed, etc). get_stats() returns a snapshot of them.
 
     The AdminApp will keep a reference to this object. All methods must
     be thread-safe.
     """
-    def __init__(self, expiretime=604800):
-        self.map = {}
+    def __init__(self, expiretime=604800, maxentries=10000, maxbytes=None, threads=4, digests=None, dbpath=None):
+        # The hashlib algorithm names we compute. md5 always comes first.
+        self.digests = [ 'md5' ]
+        if digests:
+            for name in digests:
+                hashlib.new(name)   # make sure it exists
+                if name not in self.digests:
+                    self.digests.append(name)
+        
+        # Maps key to MapEntry, least recently used first.
+        self.map = OrderedDict()
         # expiretime defaults to seven days
         self.expiretime = expiretime
-        
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        # Sum of ent.size over the map.
+        self.totalbytes = 0
+        # Maps pathname to key, for the pathname we last saw each key at.
+        self.pathmap = {}
+
+        # Maps key to InFlight, for hashes currently being computed.
+        self.inflight = {}
+
+        # Counters. These are updated under the lock.
+        self.stats = {
+            'hits': 0,            # found in memory
+            'storehits': 0,       # found in the on-disk store
+            'misses': 0,          # had to read the file
+            'inflightwaits': 0,   # waited for another thread's read
+            'inflightbytes': 0,   # ...and the bytes we didn't read
+            'evictions': 0,       # dropped for the size limits
+            'expirations': 0,     # dropped for age
+            'byteshashed': 0,
+            'hashtime': 0.0,      # seconds spent reading and hashing
+            'largestfile': 0,
+            'largestpath': None,
+        }
+        self.starttime = time.time()
+
+        # Worker pool for get_digests_many(). Created when first needed.
+        self.threads = threads
+        self.executor = None
+
         # Any access to the map must be done under this lock.
         self.lock = threading.Lock()
 
+        # The on-disk store, if any. We keep one db connection per
+        # thread, like AdminApp.getdb().
+        self.dbpath = dbpath
+        self.threadcache = threading.local()
+
+    def getdb(self):
+        """Get or create a sqlite3 connection to the on-disk store.
+        Returns None if there is no store (or we can't open it).
+        """
+        if not self.dbpath:
+            return None
+        db = getattr(self.threadcache, 'db', None)
+        if db is None:
+            try:
+                db = sqlite3.connect(self.dbpath)
+                db.isolation_level = None   # autocommit
+                db.execute('CREATE TABLE IF NOT EXISTS filehashes(dev, ino, size, mtime, pathname, md5, lastuse, digests, PRIMARY KEY (dev, ino, size, mtime))')
+                res = db.execute('PRAGMA table_info(filehashes)')
+                if 'digests' not in [ tup[1] for tup in res.fetchall() ]:
+                    db.execute('ALTER TABLE filehashes ADD COLUMN digests')
+            except sqlite3.Error as ex:
+                logging.warning('Unable to open hash store %s: %s', self.dbpath, ex)
+                return None
+            self.threadcache.db = db
+        return db
+
     def get_md5(self, pathname, sizelimit=None):
         """Get an MD5 checksum from a file.
         If sizelimit is not None, we bail out (returning None) for files
@@ -34,6 +131,52 @@ class Hasher:
         md5, size = self.get_md5_size(pathname, sizelimit=sizelimit)
         return md5
 
+    def get_md5_many(self, pathnames, sizelimit=None):
+        """Get MD5 checksums for a list of files, hashing them in parallel.
+        Returns a dict mapping each pathname to its md5. The value is None
+        if the file is unreadable or (with sizelimit) too large.
+        This takes about as long as the largest uncached file, rather
+        than the sum of them.
+        """
+        results = self.get_digests_many(pathnames, sizelimit=sizelimit)
+        return dict([ (pathname, (val[0]['md5'] if val else None)) for pathname, val in results.items() ])
+
+    def get_digests_many(self, pathnames, sizelimit=None, progress=None):
+        """Get all checksums and sizes for a list of files, hashing them in
+        parallel. Returns a dict mapping each pathname to a (digests, size)
+        pair, as get_digests() would return. The value is None if the file
+        is unreadable or (with sizelimit) too large.
+        If progress is supplied, it's called as progress(pathname, val)
+        after each file, in list order.
+        """
+        def work(pathname):
+            try:
+                digests, size = self.get_digests(pathname, sizelimit=sizelimit)
+                if digests is None:
+                    return None
+                return (digests, size)
+            except OSError:
+                return None
+
+        if len(pathnames) <= 1 or self.threads <= 1:
+            results = map(work, pathnames)
+        else:
+            results = self.get_executor().map(work, pathnames)
+        res = {}
+        for pathname, val in zip(pathnames, results):
+            res[pathname] = val
+            if progress:
+                progress(pathname, val)
+        return res
+
+    def get_executor(self):
+        """Get or create the worker pool for get_digests_many().
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='hasher')
+            return self.executor
+
     def get_size(self, pathname):
         """Get the size of a file. (This doesn't use the cache; it's
         here for completeness.)
@@ -47,48 +190,287 @@ class Hasher:
         (This is handy if you're checking a bunch of files and don't
         want to be bogged down on the really big ones.)
         """
+        digests, size = self.get_digests(pathname, sizelimit=sizelimit)
+        if digests is None:
+            return (None, None)
+        return digests['md5'], size
+
+    def get_digests(self, pathname, sizelimit=None):
+        """Get all the checksums we compute for a file, and its size.
+        The checksums are returned as a dict mapping algorithm name
+        (as in self.digests) to hex digest. The dict must not be modified.
+        If sizelimit is not None, we bail out (returning (None, None))
+        for files larger than that.
+        """
+        # Absolute paths, so that command-line runs share cache entries
+        # with the web app.
+        pathname = os.path.abspath(pathname)
         stat = os.stat(pathname)
-        key = (pathname, stat.st_size, int(stat.st_mtime))
+        key = stat_key(stat)
         now = time.time()
 
         if sizelimit is not None and stat.st_size >= sizelimit:
             return (None, None)
-        
+
         with self.lock:
             ent = self.map.get(key)
             if ent is not None:
                 ent.lastuse = now
-                return ent.md5, ent.size
+                self.map.move_to_end(key)
+                self.stats['hits'] += 1
+                return ent.digests, ent.size
+
+            # If another thread is already working on this key, we'll
+            # wait for it. Otherwise, we're the one doing the work.
+            flight = self.inflight.get(key)
+            if flight is None:
+                flight = InFlight()
+                self.inflight[key] = flight
+                owner = True
+            else:
+                self.stats['inflightwaits'] += 1
+                self.stats['inflightbytes'] += stat.st_size
+                owner = False
 
-        # Gotta do this the hard way. Note that we do the md5 computation
-        # *outside* the lock. There's a small chance that two threads will
-        # start this work at the same time, but that's okay.
+        if not owner:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.digests, stat.st_size
 
-        hasher = hashlib.md5()
-        if stat.st_size > 0:
+        # Note that we do the hash computation *outside* the lock.
+        digests = None
+        stored = False
+        elapsed = None
+        try:
+            # Maybe another process has already done the work.
+            digests = self.load_stored(key, now)
+            if digests is not None:
+                stored = True
+            else:
+                # Gotta do this the hard way.
+                starttime = time.perf_counter()
+                digests = self.compute_digests(pathname, stat.st_size)
+                elapsed = time.perf_counter() - starttime
+                self.save_stored(key, pathname, now, digests)
+        except Exception as ex:
+            flight.error = ex
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+                if stored:
+                    self.stats['storehits'] += 1
+                elif elapsed is not None:
+                    self.stats['misses'] += 1
+                    self.stats['byteshashed'] += stat.st_size
+                    self.stats['hashtime'] += elapsed
+                    if stat.st_size > self.stats['largestfile']:
+                        self.stats['largestfile'] = stat.st_size
+                        self.stats['largestpath'] = pathname
+                if digests is not None:
+                    flight.digests = digests
+                    self.add_entry(MapEntry(key, pathname, now, digests))
+                    # This is a good time to clean out old entries.
+                    self.trim(now)
+            flight.event.set()
+
+        return digests, stat.st_size
+
+    def compute_digests(self, pathname, size):
+        """Read a file and compute all its checksums, in one pass.
+        (No caching here.)
+        """
+        hashers = [ hashlib.new(name) for name in self.digests ]
+        if size > 0:
             # We only need to read non-zero-length files!
-            fl = open(pathname, 'rb')
-            while True:
-                dat = fl.read(16384)
-                if not dat:
-                    break
-                hasher.update(dat)
-            fl.close()
-        md5 = hasher.hexdigest()
+            digest_file(hashers, pathname, size)
+        return dict(zip(self.digests, [ hasher.hexdigest() for hasher in hashers ]))
+
+    def is_cached(self, pathname, stat=None):
+        """Check whether a file's md5 is in the in-memory cache. (This
+        doesn't touch the entry's LRU position.)
+        """
+        if stat is None:
+            stat = os.stat(pathname)
+        key = stat_key(stat)
+        with self.lock:
+            return (key in self.map)
+
+    def moved(self, oldpath, newpath):
+        """Let us know that a file has been moved or renamed. Call this
+        after the move is complete.
+        If the file stayed on the same filesystem, its key hasn't changed;
+        we just note the new pathname. If it was copied to a different
+        filesystem, it has a new inode, so we carry its hash over to the
+        new key. (As long as the size and modtime survived the trip;
+        shutil.move() preserves those.)
+        """
+        oldpath = os.path.abspath(oldpath)
+        newpath = os.path.abspath(newpath)
+        try:
+            stat = os.stat(newpath)
+        except OSError:
+            return
+        newkey = stat_key(stat)
+        now = time.time()
 
         with self.lock:
-            # This is a good time to clean out old entries.
-            timelimit = now - self.expiretime
-            delkeys = [ dkey for dkey, dent in self.map.items() if dent.lastuse < timelimit ]
-            if delkeys:
-                for dkey in delkeys:
-                    del self.map[dkey]
-                    
-            # Another thread might have created an entry for this key;
-            # we'll just replace it. It was identical anyhow.
-            ent = MapEntry(key, now, md5)
-            self.map[key] = ent
-            return ent.md5, ent.size
+            oldkey = self.pathmap.get(oldpath)
+            if oldkey is None:
+                return
+            ent = self.map.get(oldkey)
+            if ent is None:
+                return
+            if oldkey == newkey:
+                self.repath(ent, newpath)
+                return
+            if ent.size != stat.st_size or ent.modtime != stat.st_mtime_ns:
+                return
+            # The old inode is gone (or at least isn't this file any more).
+            self.remove_entry(ent)
+            self.add_entry(MapEntry(newkey, newpath, now, ent.digests))
+            digests = ent.digests
+
+        if oldkey == newkey:
+            self.moved_stored(newkey, newpath)
+        else:
+            self.save_stored(newkey, newpath, now, digests)
+
+    def add_entry(self, ent):
+        """Add an entry to the map (replacing any entry with the same key).
+        This must be called under the lock.
+        """
+        oldent = self.map.get(ent.key)
+        if oldent is not None:
+            self.remove_entry(oldent)
+        self.map[ent.key] = ent
+        self.totalbytes += ent.size
+        self.pathmap[ent.pathname] = ent.key
+
+    def remove_entry(self, ent):
+        """Remove an entry from the map.
+        This must be called under the lock.
+        """
+        del self.map[ent.key]
+        self.totalbytes -= ent.size
+        if self.pathmap.get(ent.pathname) == ent.key:
+            del self.pathmap[ent.pathname]
+
+    def repath(self, ent, pathname):
+        """Change the pathname of an entry.
+        This must be called under the lock.
+        """
+        if self.pathmap.get(ent.pathname) == ent.key:
+            del self.pathmap[ent.pathname]
+        ent.pathname = pathname
+        self.pathmap[pathname] = ent.key
+
+    def trim(self, now):
+        """Discard entries from the least-recently-used end of the map
+        until nothing is expired and we're within our size limits.
+        This must be called under the lock.
+        """
+        timelimit = now - self.expiretime
+        while self.map:
+            ent = next(iter(self.map.values()))
+            if ent.lastuse < timelimit:
+                self.stats['expirations'] += 1
+            elif (len(self.map) > self.maxentries
+                  or (self.maxbytes and self.totalbytes > self.maxbytes)):
+                self.stats['evictions'] += 1
+            else:
+                break
+            self.remove_entry(ent)
+
+    def get_stats(self):
+        """Return a snapshot of the counters, plus the current size of
+        the cache and the configured limits. This is a plain dict, so it
+        can be dumped as JSON.
+        """
+        with self.lock:
+            res = dict(self.stats)
+            res['entries'] = len(self.map)
+            res['totalbytes'] = self.totalbytes
+            res['inflight'] = len(self.inflight)
+        res['maxentries'] = self.maxentries
+        res['maxbytes'] = self.maxbytes
+        res['expiretime'] = self.expiretime
+        res['digests'] = list(self.digests)
+        res['uptime'] = time.time() - self.starttime
+        lookups = res['hits'] + res['storehits'] + res['misses'] + res['inflightwaits']
+        res['hitrate'] = (lookups - res['misses']) / lookups if lookups else None
+        res['hashrate'] = res['byteshashed'] / res['hashtime'] if res['hashtime'] else None
+        return res
+
+    def load_stored(self, key, now):
+        """Look up a key in the on-disk store. Returns the digests dict,
+        or None if it's not there (or there is no store).
+        The md5 is stored in its own column; any other digests are in
+        the "digests" column as a JSON object. If an entry is missing
+        one of the digests we want, it counts as a miss.
+        """
+        db = self.getdb()
+        if db is None:
+            return None
+        try:
+            res = db.execute('SELECT md5, digests, lastuse FROM filehashes WHERE dev = ? AND ino = ? AND size = ? AND mtime = ?', key)
+            tup = res.fetchone()
+            if not tup:
+                return None
+            md5, extra, lastuse = tup
+            digests = { 'md5': md5 }
+            if extra:
+                digests.update(json.loads(extra))
+            for name in self.digests:
+                if name not in digests:
+                    return None
+            # Keep the entry alive, but don't write on every hit. Once
+            # a day is plenty.
+            if now - lastuse > 86400:
+                db.execute('UPDATE filehashes SET lastuse = ? WHERE dev = ? AND ino = ? AND size = ? AND mtime = ?', (now,)+key)
+            return digests
+        except sqlite3.Error as ex:
+            logging.warning('Unable to read hash store: %s', ex)
+            return None
+
+    def save_stored(self, key, pathname, now, digests):
+        """Record a key in the on-disk store (if there is one).
+        Failure here is not fatal; we'll just have to hash the file
+        again next time.
+        """
+        db = self.getdb()
+        if db is None:
+            return
+        try:
+            extra = dict([ (name, val) for name, val in digests.items() if name != 'md5' ])
+            extra = json.dumps(extra) if extra else None
+            db.execute('INSERT OR REPLACE INTO filehashes (dev, ino, size, mtime, pathname, md5, digests, lastuse) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', key+(pathname, digests['md5'], extra, now))
+        except sqlite3.Error as ex:
+            logging.warning('Unable to write hash store: %s', ex)
+
+    def moved_stored(self, key, pathname):
+        """Update the pathname of an entry in the on-disk store. (This
+        is just for tidiness; the pathname isn't part of the key.)
+        """
+        db = self.getdb()
+        if db is None:
+            return
+        try:
+            db.execute('UPDATE filehashes SET pathname = ? WHERE dev = ? AND ino = ? AND size = ? AND mtime = ?', (pathname,)+key)
+        except sqlite3.Error as ex:
+            logging.warning('Unable to write hash store: %s', ex)
+
+    def expire_stored(self):
+        """Delete old entries from the on-disk store. Returns the number
+        of entries deleted. (Called from the cleanup command.)
+        """
+        db = self.getdb()
+        if db is None:
+            return 0
+        timelimit = time.time() - self.expiretime
+        res = db.execute('DELETE FROM filehashes WHERE lastuse < ?', (timelimit,))
+        return res.rowcount
 
     def dump(self):
         """Get all the pathnames and md5s in the cache. We only use this
@@ -98,12 +480,195 @@ class Hasher:
             ls = [ (ent.pathname, ent.md5) for ent in self.map.values() ]
         return ls
 
+class Prehasher:
+    """Background worker which keeps the Hasher warm for a list of
+    directories (/incoming and /unprocessed). Every interval seconds, it
+    scans the directories and hashes any file that isn't already cached.
+    That way the first person to view the directory after an upload
+    doesn't have to wait for it.
+
+    We hash at most threads files at once, and at most budget bytes per
+    pass. (If there's more than that, we get to it next pass.) Files
+    modified in the last settletime seconds are skipped; they may still
+    be uploading.
+
+    Every web server process has a Prehasher. If the hasher has a
+    shared store, pass lockpath: each pass takes an flock() on it first,
+    and if another process holds it, we skip the pass. That way only
+    one process reads the files at a time; the others pick up its
+    results from the store. (Without a store there's nothing to share,
+    so leave lockpath as None and every process does its own passes.)
+    """
+    def __init__(self, hasher, dirs, interval=60, threads=2, budget=None, settletime=10, lockpath=None):
+        self.hasher = hasher
+        self.lockpath = lockpath
+        self.dirs = dirs
+        self.interval = interval
+        self.threads = threads
+        self.budget = budget
+        self.settletime = settletime
+        self.thread = None
+        self.executor = None
+
+    def start(self):
+        """Start the background thread. It's a daemon thread, so it
+        won't keep the process alive.
+        """
+        if self.thread is not None:
+            return
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='prehash')
+        self.thread = threading.Thread(target=self.run, name='prehasher', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.scan()
+            except Exception as ex:
+                logging.warning('Prehash scan failed: %s', ex)
+
+    def scan(self):
+        """Do one pass over the directories, if no other process is
+        doing so. Returns (count, bytes) of the files hashed.
+        """
+        if not self.lockpath:
+            return self.scan_locked()
+        fl = open(self.lockpath, 'a')
+        try:
+            try:
+                fcntl.flock(fl.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # Somebody else is on it.
+                return (0, 0)
+            return self.scan_locked()
+        finally:
+            # Closing the file releases the lock.
+            fl.close()
+
+    def scan_locked(self):
+        now = time.time()
+        todo = []
+        for dirpath in self.dirs:
+            for ent in os.scandir(dirpath):
+                if not ent.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    stat = ent.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if not stat.st_size or stat.st_mtime > now - self.settletime:
+                    continue
+                if self.hasher.is_cached(ent.path, stat):
+                    continue
+                todo.append( (stat.st_mtime, stat.st_size, ent.path) )
+
+        # Newest files first; those are the ones people will look at.
+        todo.sort(reverse=True)
+        paths = []
+        total = 0
+        for mtime, size, pathname in todo:
+            if self.budget and paths and total + size > self.budget:
+                break
+            paths.append(pathname)
+            total += size
+        if not paths:
+            return (0, 0)
+
+        def work(pathname):
+            try:
+                self.hasher.get_md5(pathname)
+            except OSError:
+                # The file went away. Fine.
+                pass
+        list(self.executor.map(work, paths))
+        logging.info('Prehashed %d files (%d bytes)', len(paths), total)
+        return (len(paths), total)
+
+        
+# Buffer size for the readinto() strategy.
+BUFFER_SIZE = 1024 * 1024
+
+def digest_file(hashers, pathname, size, strategy=None):
+    """Feed the contents of a file into a list of hashlib objects. (We
+    read the file once, however many hashers there are.)
+    The strategies are:
+    - 'filedigest': hashlib.file_digest(), which is a C-level readinto()
+      loop. Only available in Python 3.11+, and only for one hasher.
+    - 'readinto': our own loop, reading into one preallocated buffer.
+    - 'mmap': map the file and hash it in one update() call. This is
+      only used when requested (by "benchhash"). It's no faster in
+      practice -- md5 is the bottleneck -- and if another process
+      truncates the file while we're reading it, we'd get SIGBUS.
+    By default we use filedigest if possible, otherwise readinto.
+    (hashlib releases the GIL for large updates, so all of these let
+    other threads run while we work.)
+    """
+    if strategy is None:
+        if hasattr(hashlib, 'file_digest') and len(hashers) == 1:
+            strategy = 'filedigest'
+        else:
+            strategy = 'readinto'
+
+    fl = open(pathname, 'rb', buffering=0)
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            # Tell the kernel to read ahead aggressively.
+            os.posix_fadvise(fl.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        
+        if strategy == 'mmap':
+            mm = mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for hasher in hashers:
+                    hasher.update(mm)
+            finally:
+                mm.close()
+        elif strategy == 'filedigest':
+            # file_digest() wants a constructor; we give it our existing
+            # object.
+            hashlib.file_digest(fl, lambda: hashers[0])
+        elif strategy == 'readinto':
+            buf = bytearray(min(size, BUFFER_SIZE))
+            view = memoryview(buf)
+            while True:
+                count = fl.readinto(buf)
+                if not count:
+                    break
+                for hasher in hashers:
+                    hasher.update(view[ : count ])
+        else:
+            raise ValueError('unknown strategy: %s' % (strategy,))
+    finally:
+        fl.close()
+
+def stat_key(stat):
+    """The cache key for a file: (device, inode, size, modtime in ns).
+    """
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+class InFlight:
+    """A hash computation in progress. Threads which want the same
+    key wait on the event; the owner sets digests (or error) before
+    signalling it.
+    """
+    __slots__ = ('event', 'digests', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.digests = None
+        self.error = None
+
 class MapEntry:
-    def __init__(self, key, now, md5):
+    __slots__ = ('key', 'digests', 'pathname', 'size', 'modtime', 'lastuse')
+
+    def __init__(self, key, pathname, now, digests):
         self.key = key
-        self.md5 = md5
-        self.pathname = key[0]
-        self.size = key[1]
-        self.modtime = key[2]
+        self.digests = digests
+        self.pathname = pathname
+        self.size = key[2]
+        self.modtime = key[3]
         self.lastuse = now
-        
+
+    @property
+    def md5(self):
+        return self.digests['md5']
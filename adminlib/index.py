@@ -1,5 +1,7 @@
 import re
 import os.path
+import time
+import threading
 from collections import OrderedDict
 
 from adminlib.info import IndexOnlyEntry
@@ -153,6 +155,20 @@ class IndexDir:
     def __repr__(self):
         return '<IndexDir %s (%s files)>' % (self.dirname, len(self.files),)
 
+    def copy(self):
+        """Create a deep clone, which can be modified without affecting
+        this one. (We don't reread the Index file.)
+        """
+        res = IndexDir.__new__(IndexDir)
+        res.dirname = self.dirname
+        res.indexpath = self.indexpath
+        res.date = self.date
+        res.description = self.description
+        res.desclines = list(self.desclines) if self.desclines is not None else None
+        res.metadata = list(self.metadata)
+        res.files = [ file.copy(res) for file in self.files ]
+        return res
+
     def getmap(self):
         """Create and return a dict mapping filenames to IndexFile objects.
         The dict also contains a '.' entry for the directory data itself.
@@ -283,6 +299,94 @@ class IndexDir:
 
         outfl.close()
 
+class IndexCache:
+    """Cache of parsed IndexDir objects, shared by all requests in the
+    process. An entry is keyed by the Index file's (mtime_ns, size), so
+    any edit to the file makes it miss.
+
+    The cached IndexDirs are shared, so they must not be modified. Pass
+    copy=True to get() if you're going to change the result (and maybe
+    write it out).
+
+    The memory bound (maxbytes) is approximate: we count the size of
+    the Index files themselves. Least-recently-used entries go first.
+    As with DirScanCache, we don't cache an Index file modified in the
+    last couple of seconds.
+
+    This is thread-safe.
+    """
+    def __init__(self, maxbytes=8388608):
+        self.maxbytes = maxbytes
+        self.totalbytes = 0
+        self.map = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+        }
+
+    def get(self, dirname, rootdir, orblank=False, copy=False):
+        """Return an IndexDir, as IndexDir(dirname, rootdir, orblank)
+        would, but from the cache if possible.
+        """
+        if dirname:
+            indexpath = os.path.join(rootdir, dirname, 'Index')
+        else:
+            indexpath = os.path.join(rootdir, 'Index')
+
+        try:
+            stat = os.stat(indexpath)
+        except FileNotFoundError:
+            stat = None
+        if stat is None or not self.maxbytes:
+            # Nothing worth caching. (IndexDir will raise the error if
+            # orblank is false.)
+            return IndexDir(dirname, rootdir=rootdir, orblank=orblank)
+        
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            ent = self.map.get(indexpath)
+            if ent is not None:
+                entkey, indexdir = ent
+                if entkey == key:
+                    self.map.move_to_end(indexpath)
+                    self.stats['hits'] += 1
+                    return indexdir.copy() if copy else indexdir
+                self.remove_entry(indexpath)
+            self.stats['misses'] += 1
+
+        indexdir = IndexDir(dirname, rootdir=rootdir, orblank=orblank)
+        if time.time() - stat.st_mtime_ns / 1000000000 >= 2:
+            with self.lock:
+                self.remove_entry(indexpath)
+                self.map[indexpath] = (key, indexdir)
+                self.totalbytes += stat.st_size
+                while self.totalbytes > self.maxbytes and len(self.map) > 1:
+                    oldpath = next(iter(self.map))
+                    self.remove_entry(oldpath)
+        # A freshly-parsed IndexDir is ours alone if we didn't cache it,
+        # but it's simpler to always copy when asked.
+        return indexdir.copy() if copy else indexdir
+
+    def remove_entry(self, indexpath):
+        """Remove an entry, if present. The lock must be held.
+        """
+        ent = self.map.pop(indexpath, None)
+        if ent is not None:
+            self.totalbytes -= ent[0][1]
+
+    def invalidate(self, indexpath):
+        with self.lock:
+            self.remove_entry(indexpath)
+
+    def get_stats(self):
+        with self.lock:
+            res = dict(self.stats)
+            res['entries'] = len(self.map)
+            res['totalbytes'] = self.totalbytes
+        res['maxbytes'] = self.maxbytes
+        return res
+
 class IndexFile:
     """Represents one entry in an Index file. Note that, despite the name,
     this may represent a file, subdirectory, symlink, or even a file
@@ -307,8 +411,8 @@ class IndexFile:
             dir = self.dir
         res = IndexFile(self.filename, dir)
         res.description = self.description
-        res.desclines = self.desclines.copy()
-        res.metadata = self.metadata.copy()
+        res.desclines = list(self.desclines) if self.desclines is not None else None
+        res.metadata = list(self.metadata)
         return res
 
     def hasdata(self):
@@ -320,7 +424,14 @@ class IndexFile:
             return True
         return False
     
-def update_file_entries(ls, indexdir, user=None):
+def update_file_entries(ls, indexdir, user=None, allnames=None, addmissing=True):
+    """Fill in the Index descriptions and metadata of a list of
+    ListEntries. Index entries for files that don't exist are appended
+    to the list as IndexOnlyEntries (unless addmissing is false).
+    If ls is only part of the directory (one page of it), allnames
+    should be the set of every name in the directory, so that we
+    don't mistake the files on other pages for missing ones.
+    """
     ifmap = indexdir.getmap()
     # ifnames excludes '.'
     ifnames = set([ ifile.filename for ifile in indexdir.files ])
@@ -332,8 +443,10 @@ def update_file_entries(ls, indexdir, user=None):
                 ent.indexdesc = ifile.description.strip()
             ent.indexmeta = ifile.metadata
         ifnames.discard(ent.name)
+    if allnames is not None:
+        ifnames.difference_update(allnames)
 
-    if ifnames:
+    if ifnames and addmissing:
         ifnames = list(ifnames)
         ifnames.sort(key=lambda val:sortcanon(val))
         for name in ifnames:
@@ -1,8 +1,10 @@
-import re
 import os, os.path
+import stat
 import time
+import threading
+from collections import OrderedDict
 
-from adminlib.util import in_user_time
+from adminlib.util import format_user_day, format_user_minute, sortcanon
 from adminlib.util import canon_archivedir, FileConsistency
 
 def formatdate(date, user=None, shortdate=False):
@@ -16,58 +18,408 @@ def formatdate(date, user=None, shortdate=False):
     historical date, use shortdate=False for a uniform display.
     (Yes, this means "shortdate=False" gives a shorter string than
     "shortdate=True". Sorry, the semantics shifted a bit.)
+    The strings are memoized; see format_user_day() and
+    format_user_minute().
     """
-    mtime = in_user_time(user, date)
     if shortdate:
         if date < time.time() - 15552000:
-            return mtime.strftime('%b %d %Y, %H:%M %Z')
+            return format_user_minute(user, date, '%b %d %Y, %H:%M %Z')
         else:
-            return mtime.strftime('%b %d, %H:%M %Z')
+            return format_user_minute(user, date, '%b %d, %H:%M %Z')
     else:
-        return mtime.strftime('%b %d, %Y')
+        return format_user_day(user, date, '%b %d, %Y')
 
-def get_dir_entries(dirpath, archivedir, dirs=False, user=None, shortdate=False):
+class ScanRecord:
+    """Raw information about one directory entry, as found by scan_dir().
+    This has no user-specific formatting, so it can be shared between
+    requests (and threads). Treat it as read-only.
+    The kind is 'file', 'dir', 'linkfile', 'linkdir', or 'linkbroken'.
+    For links, stat is the target's stat (or the link's own, if broken),
+    target is the link text, and realpath is the target's path relative
+    to the Archive root (None if broken).
+    """
+    __slots__ = ('name', 'kind', 'stat', 'target', 'realpath')
+    
+    def __init__(self, name, kind, stat, target=None, realpath=None):
+        self.name = name
+        self.kind = kind
+        self.stat = stat
+        self.target = target
+        self.realpath = realpath
+
+    def __repr__(self):
+        return '<ScanRecord %s "%s">' % (self.kind, self.name,)
+
+class SymlinkResolver:
+    """Work out where symlinks point. A link is resolved to a tuple
+    (kind, stat, target, realpath), as described for ScanRecord; kind is
+    None if the path isn't a symlink at all, or if it points at
+    something that's neither a file nor a directory.
+
+    The link text and real path are cached across requests, keyed on
+    the link's pathname and checked against its lstat (a replaced link
+    has a new inode or ctime). Links to links, or through linked
+    directories, aren't cached. So a cached link costs an lstat and a
+    stat of the target, rather than readlink, realpath (which looks at
+    every path component), and several stats.
+    The caller may also supply a memo dict, which remembers the complete
+    results for the duration of one request.
+
+    This is thread-safe.
+    """
+    def __init__(self, archivedir, maxentries=5000):
+        self.archivedir = archivedir
+        self.maxentries = maxentries
+        self.map = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+        }
+
+    def resolve(self, linkpath, lstat=None, memo=None):
+        """Resolve one symlink. If the caller already has its lstat
+        (e.g. from os.scandir()), pass it in.
+        """
+        if memo is not None:
+            res = memo.get(linkpath)
+            if res is not None:
+                return res
+            
+        if lstat is None:
+            try:
+                lstat = os.lstat(linkpath)
+            except OSError:
+                return (None, None, None, None)
+        if not stat.S_ISLNK(lstat.st_mode):
+            return (None, None, None, None)
+
+        sig = (lstat.st_ino, lstat.st_ctime_ns)
+        res = None
+        if self.maxentries:
+            with self.lock:
+                ent = self.map.get(linkpath)
+                if ent is not None and ent[0] == sig:
+                    self.map.move_to_end(linkpath)
+                    self.stats['hits'] += 1
+                else:
+                    ent = None
+            # Stat the target outside the lock, so that other threads
+            # aren't kept waiting on the filesystem.
+            if ent is not None:
+                _, target, path = ent
+                res = self.check_target(lstat, target, path)
+                # If the target has vanished, the path might be stale (a
+                # directory link further up could have changed), so we
+                # drop the entry and resolve it properly before calling
+                # it broken.
+                if res[0] == 'linkbroken':
+                    res = None
+                    with self.lock:
+                        if self.map.get(linkpath) is ent:
+                            del self.map[linkpath]
+
+        if res is None:
+            target = os.readlink(linkpath)
+            path = os.path.realpath(linkpath)
+            res = self.check_target(lstat, target, path)
+            # We only keep links whose real path is just the link text
+            # applied to the link's directory. If the path runs through
+            # another symlink, that link could change without this one's
+            # lstat noticing.
+            cacheable = (path == os.path.normpath(os.path.join(os.path.dirname(linkpath), target)))
+            if self.maxentries:
+                with self.lock:
+                    self.stats['misses'] += 1
+                    if cacheable:
+                        self.map[linkpath] = (sig, target, path)
+                        self.map.move_to_end(linkpath)
+                        while len(self.map) > self.maxentries:
+                            self.map.popitem(last=False)
+
+        if memo is not None:
+            memo[linkpath] = res
+        return res
+
+    def check_target(self, lstat, target, path):
+        # By this rule, a link to the root if-archive directory itself will show as broken. Fine.
+        if path.startswith(self.archivedir+'/'):
+            try:
+                tstat = os.stat(path)
+            except OSError:
+                tstat = None
+            if tstat is not None:
+                relpath = path[ len(self.archivedir)+1 : ]
+                if stat.S_ISREG(tstat.st_mode):
+                    return ('linkfile', tstat, target, relpath)
+                elif stat.S_ISDIR(tstat.st_mode):
+                    return ('linkdir', tstat, target, relpath)
+                else:
+                    return (None, None, None, None)
+        # Gotta use the link's own stat
+        return ('linkbroken', lstat, target, None)
+
+    def get_stats(self):
+        with self.lock:
+            res = dict(self.stats)
+            res['entries'] = len(self.map)
+        res['maxentries'] = self.maxentries
+        return res
+
+def scan_dir(dirpath, archivedir, resolver=None, memo=None):
+    """Scan a directory, returning a tuple of ScanRecords. This does all
+    the filesystem work for get_dir_entries(): the stats and the symlink
+    resolution.
+    Symlinks are resolved by the given SymlinkResolver (with an optional
+    per-request memo dict), or an uncached one if none is given.
+    """
+    if resolver is None:
+        resolver = SymlinkResolver(archivedir, maxentries=0)
+    records = []
+    for ent in os.scandir(dirpath):
+        if ent.is_symlink():
+            kind, lstat, target, relpath = resolver.resolve(ent.path, lstat=ent.stat(follow_symlinks=False), memo=memo)
+            if kind:
+                records.append(ScanRecord(ent.name, kind, lstat, target=target, realpath=relpath))
+        elif ent.is_file():
+            records.append(ScanRecord(ent.name, 'file', ent.stat()))
+        elif ent.is_dir():
+            records.append(ScanRecord(ent.name, 'dir', ent.stat()))
+    return tuple(records)
+
+class DirScanCache:
+    """Cache of scan_dir() results, shared by all requests in the process.
+    An entry is good as long as the directory's mtime hasn't changed
+    (adding, removing, or renaming an entry changes it) and it's no more
+    than maxage seconds old.
+
+    The mtime doesn't notice a file being rewritten in place, or a
+    symlink target changing somewhere else. So handlers that modify
+    files must call invalidate() on the directories they touched; and
+    maxage bounds the staleness of changes made outside the admintool.
+    We also don't cache a directory whose mtime is within the last
+    couple of seconds, because further changes in the same clock tick
+    would go unnoticed.
+
+    Symlinks are resolved with the given SymlinkResolver, if any.
+
+    This is thread-safe.
+    """
+    def __init__(self, maxentries=200, maxage=300, resolver=None):
+        self.maxentries = maxentries
+        self.maxage = maxage
+        self.resolver = resolver
+        self.map = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'invalidations': 0,
+        }
+
+    def scan(self, dirpath, archivedir):
+        """Return scan_dir(dirpath, archivedir), from the cache if
+        possible.
+        """
+        if not self.maxage:
+            return scan_dir(dirpath, archivedir, resolver=self.resolver)
+        
+        mtime = os.stat(dirpath).st_mtime_ns
+        now = time.time()
+        with self.lock:
+            ent = self.map.get(dirpath)
+            if ent is not None:
+                entmtime, scantime, records = ent
+                if entmtime == mtime and now - scantime < self.maxage:
+                    self.map.move_to_end(dirpath)
+                    self.stats['hits'] += 1
+                    return records
+                del self.map[dirpath]
+            self.stats['misses'] += 1
+
+        # Scan outside the lock. If the directory changes while we're
+        # scanning, its mtime will no longer match the one we store, so
+        # the next request will scan again.
+        records = scan_dir(dirpath, archivedir, resolver=self.resolver)
+        if now - mtime / 1000000000 < 2:
+            return records
+        
+        with self.lock:
+            self.map[dirpath] = (mtime, now, records)
+            self.map.move_to_end(dirpath)
+            while len(self.map) > self.maxentries:
+                self.map.popitem(last=False)
+        return records
+
+    def invalidate(self, *dirpaths):
+        """Forget about one or more directories.
+        """
+        with self.lock:
+            for dirpath in dirpaths:
+                if self.map.pop(dirpath, None) is not None:
+                    self.stats['invalidations'] += 1
+
+    def get_stats(self):
+        with self.lock:
+            res = dict(self.stats)
+            res['entries'] = len(self.map)
+        res['maxentries'] = self.maxentries
+        res['maxage'] = self.maxage
+        return res
+
+def make_list_entry(rec, dirs=False, user=None, shortdate=False):
+    """Create a FileEntry, DirEntry, or SymlinkEntry from a ScanRecord.
+    Returns None for directories (and links to directories) unless dirs
+    is set, and always for lost+found.
+    """
+    kind = rec.kind
+    if kind == 'file':
+        return FileEntry(rec.name, rec.stat, user=user, shortdate=shortdate)
+    elif kind == 'dir':
+        if not dirs:
+            return None
+        if rec.name == 'lost+found':
+            # special case; skip it
+            return None
+        return DirEntry(rec.name, rec.stat, user=user, shortdate=shortdate)
+    elif kind == 'linkfile':
+        return SymlinkEntry(rec.name, rec.target, rec.stat, realpath=rec.realpath, isdir=False, user=user, shortdate=shortdate)
+    elif kind == 'linkdir':
+        if not dirs:
+            return None
+        return SymlinkEntry(rec.name, rec.target, rec.stat, realpath=rec.realpath, isdir=True, user=user, shortdate=shortdate)
+    elif kind == 'linkbroken':
+        return SymlinkEntry(rec.name, rec.target, rec.stat, isdir=False, isbroken=True, user=user, shortdate=shortdate)
+    return None
+
+def scan_records(dirpath, archivedir, cache=None, resolver=None, memo=None):
+    """Get the ScanRecords for a directory, through a DirScanCache if
+    supplied. Otherwise, see scan_dir().
+    """
+    if cache is not None:
+        return cache.scan(dirpath, archivedir)
+    return scan_dir(dirpath, archivedir, resolver=resolver, memo=memo)
+
+def get_dir_entries(dirpath, archivedir, dirs=False, user=None, shortdate=False, cache=None, resolver=None, memo=None):
     """Get a list of FileEntries from a given directory.
     Include DirEntries if requested.
     SymlinkEntries for files will always be included; for dirs too if
     requested.
     Can supply user and shortdate options (for timestamp formatting).
+    If cache (a DirScanCache) is supplied, the directory scan may come
+    from there; the entries themselves are always created fresh. If
+    not, resolver and memo are passed to scan_dir().
     """
-    filelist = []
+    records = scan_records(dirpath, archivedir, cache=cache, resolver=resolver, memo=memo)
     
-    for ent in os.scandir(dirpath):
-        if ent.is_symlink():
-            target = os.readlink(ent)
-            path = os.path.realpath(ent.path)
-            # By this rule, a link to the root if-archive directory itself will show as broken. Fine.
-            if path.startswith(archivedir+'/') and os.path.exists(path):
-                relpath = path[ len(archivedir)+1 : ]
-                if os.path.isfile(path):
-                    stat = os.stat(path)
-                    file = SymlinkEntry(ent.name, target, stat, realpath=relpath, isdir=False, user=user, shortdate=shortdate)
-                    filelist.append(file)
-                elif dirs and os.path.isdir(path):
-                    stat = os.stat(path)
-                    dir = SymlinkEntry(ent.name, target, stat, realpath=relpath, isdir=True, user=user, shortdate=shortdate)
-                    filelist.append(dir)
-            else:
-                # Gotta use the link's own stat
-                stat = os.lstat(ent.path)
-                file = SymlinkEntry(ent.name, target, stat, isdir=False, isbroken=True, user=user, shortdate=shortdate)
-                filelist.append(file)
-        elif ent.is_file():
-            stat = ent.stat()
-            file = FileEntry(ent.name, stat, user=user, shortdate=shortdate)
-            filelist.append(file)
-        elif dirs and ent.is_dir():
-            if ent.name == 'lost+found':
-                # special case; skip it
-                continue
-            stat = ent.stat()
-            dir = DirEntry(ent.name, stat, user=user, shortdate=shortdate)
-            filelist.append(dir)
+    filelist = []
+    for rec in records:
+        ent = make_list_entry(rec, dirs=dirs, user=user, shortdate=shortdate)
+        if ent is not None:
+            filelist.append(ent)
 
     return filelist
+
+# Ways to sort a paged listing. (Subdirectories are always sorted by name.)
+LISTING_SORTS = [ 'name', 'date', 'size' ]
+
+def name_matches_prefix(name, prefix):
+    """Check a filename against a (case-insensitive) prefix filter.
+    An empty prefix matches everything.
+    """
+    if not prefix:
+        return True
+    return name.lower().startswith(prefix.lower())
+
+class ListingPage:
+    """One page of a directory listing, as returned by get_dir_page().
+    The subdirs and files lists contain ListEntries; everything else
+    is bookkeeping for the page links.
+    """
+    def __init__(self, subdirs, files, total, start, count, allnames, isempty):
+        self.subdirs = subdirs
+        self.files = files
+        # The number of files that match the prefix filter (on all pages).
+        self.total = total
+        self.start = start
+        self.count = count
+        # The names of every entry in the directory, filtered or not.
+        self.allnames = allnames
+        # As dir_is_empty() would say for the whole directory.
+        self.isempty = isempty
+
+    def __repr__(self):
+        return '<ListingPage %d-%d of %d>' % (self.start, self.start+len(self.files), self.total,)
+
+    @property
+    def pagenum(self):
+        if not self.count:
+            return 1
+        return self.start // self.count + 1
+
+    @property
+    def pagecount(self):
+        if not self.count or not self.total:
+            return 1
+        return (self.total + self.count - 1) // self.count
+
+    @property
+    def islast(self):
+        return self.pagenum >= self.pagecount
+
+def get_dir_page(dirpath, archivedir, sort='name', reverse=False, prefix=None, start=0, count=None, user=None, shortdate=False, cache=None, resolver=None, memo=None):
+    """Get one page of a directory listing, as a ListingPage.
+    All subdirectories (and links to them) are included; files (and
+    file links) are sorted, and then only count of them are returned,
+    beginning at start. If start is past the end, we return the last
+    page instead. If count is None, all files are returned.
+    If prefix is supplied, only entries whose names begin with it
+    are included.
+    The sorting and slicing is done on the raw ScanRecords, so we only
+    create ListEntries for the entries we return.
+    The cache, resolver, and memo arguments are as for get_dir_entries().
+    """
+    records = scan_records(dirpath, archivedir, cache=cache, resolver=resolver, memo=memo)
+
+    isempty = True
+    allnames = set()
+    dirrecs = []
+    filerecs = []
+    for rec in records:
+        allnames.add(rec.name)
+        if rec.kind == 'file':
+            if rec.stat.st_size:
+                isempty = False
+        elif not (rec.kind == 'dir' and rec.name == 'lost+found'):
+            isempty = False
+        if not name_matches_prefix(rec.name, prefix):
+            continue
+        if rec.kind == 'dir' or rec.kind == 'linkdir':
+            dirrecs.append(rec)
+        else:
+            filerecs.append(rec)
+
+    if sort == 'date':
+        filerecs.sort(key=lambda rec:rec.stat.st_mtime, reverse=reverse)
+    elif sort == 'size':
+        filerecs.sort(key=lambda rec:rec.stat.st_size, reverse=reverse)
+    else:
+        filerecs.sort(key=lambda rec:sortcanon(rec.name), reverse=reverse)
+
+    total = len(filerecs)
+    if not count:
+        start = 0
+    else:
+        if start >= total:
+            start = max(0, (total-1) // count * count)
+        filerecs = filerecs[ start : start+count ]
+
+    dirrecs.sort(key=lambda rec:sortcanon(rec.name))
+    subdirs = [ make_list_entry(rec, dirs=True, user=user, shortdate=shortdate) for rec in dirrecs ]
+    subdirs = [ ent for ent in subdirs if ent is not None ]
+    files = [ make_list_entry(rec, user=user, shortdate=shortdate) for rec in filerecs ]
+
+    return ListingPage(subdirs, files, total, start, count, allnames, isempty)
     
 def dir_is_empty(ls):
     """Given a list of ListEntry objects, return True if there are no
@@ -90,10 +442,19 @@ class ListEntry:
     Objects in these classes should always have isfile, isdir, and
     islink set, and isdir should be (not isfile). (A link can
     be either.)
+    The fdate property is the formatted date, for the given user (see
+    formatdate()). It's computed when the template asks for it.
+    A big directory has a lot of these, so they use __slots__. (An
+    attribute that a subclass doesn't set will just be undefined in
+    the template, as before.)
     """
-    def __init__(self, name):
+    __slots__ = ('name', 'date', 'user', 'shortdate', 'isdir', 'isfile', 'islink', 'isbroken', 'indexdesc', 'indexmeta')
+    
+    def __init__(self, name, user=None, shortdate=False):
         self.name = name
         self.date = None
+        self.user = user
+        self.shortdate = shortdate
 
         # Exactly one of these should wind up set.
         self.isdir = False
@@ -109,6 +470,10 @@ class ListEntry:
         self.indexdesc = None
         self.indexmeta = None
 
+    @property
+    def fdate(self):
+        return formatdate(self.date, user=self.user, shortdate=self.shortdate)
+
 class FileEntry(ListEntry):
     """Represents one file in a directory.
     
@@ -125,34 +490,60 @@ class FileEntry(ListEntry):
         '.listing',
     ])
 
-    # Some files can be sent to iplayif.com for web play.
-    # Most files, really; so many that this pattern is the converse.
-    pat_noiplay = re.compile('[.](zip|gz|tgz|txt|text|jpg|jpeg|png|gif|pdf|htm|html|svg)$', re.IGNORECASE)
-
+    # How to treat a file, by (lowercase) extension: a tuple of
+    # (ishtml, isunbox, isiplay).
     # Some files should be zipped because they potentially contain
     # scripting. (HTML and also SVG.)
-    pat_html = re.compile('[.](htm|html|svg)$', re.IGNORECASE)
-
     # Some files should be shown with an Unbox link.
-    pat_unbox = re.compile('[.](zip|tgz|tar.gz)$', re.IGNORECASE)
+    # Some files can be sent to iplayif.com for web play. Most files,
+    # really; so that's the default, and this table lists the exceptions.
+    extflags = {
+        'htm': (True, False, False),
+        'html': (True, False, False),
+        'svg': (True, False, False),
+        'zip': (False, True, False),
+        'tgz': (False, True, False),
+        'gz': (False, False, False),
+        'txt': (False, False, False),
+        'text': (False, False, False),
+        'jpg': (False, False, False),
+        'jpeg': (False, False, False),
+        'png': (False, False, False),
+        'gif': (False, False, False),
+        'pdf': (False, False, False),
+    }
+    defaultflags = (False, False, True)
+    targzflags = (False, True, False)
+
+    __slots__ = ('size', 'isspecial', 'ishtml', 'isunbox', 'isiplay', 'uploads', 'identical')
+    
+    @classmethod
+    def classify(cls, filename):
+        """Return the (ishtml, isunbox, isiplay) flags for a filename.
+        """
+        _, dot, ext = filename.rpartition('.')
+        if not dot:
+            return cls.defaultflags
+        ext = ext.lower()
+        if ext == 'gz' and filename[ -7 : ].lower() == '.tar.gz':
+            return cls.targzflags
+        return cls.extflags.get(ext, cls.defaultflags)
     
     def __init__(self, filename, stat, user=None, shortdate=False):
-        ListEntry.__init__(self, filename)
+        ListEntry.__init__(self, filename, user=user, shortdate=shortdate)
         # The user argument says what user to display this file *for*.
         # (We use this to localize the time to their timezone.) If
         # user is not provided, we'll display in UTC.
         self.date = stat.st_mtime
         self.size = stat.st_size
         self.isspecial = (filename in self.specialnames)
-        self.ishtml = bool(self.pat_html.search(filename))
-        self.isunbox = bool(self.pat_unbox.search(filename))
-        self.isiplay = not bool(self.pat_noiplay.search(filename))
+        self.ishtml, self.isunbox, self.isiplay = self.classify(filename)
         self.isfile = True
-        
-        self.fdate = formatdate(self.date, user=user, shortdate=shortdate)
 
-        # We don't fill this in, but the caller might.
+        # We don't fill these in, but the caller might. (identical is
+        # a list of Archive paths with the same contents.)
         self.uploads = None
+        self.identical = None
 
     def __repr__(self):
         return '<FileEntry "%s">' % (self.name,)
@@ -166,14 +557,14 @@ class DirEntry(ListEntry):
         'lost+found',
     ])
 
+    __slots__ = ('isspecial',)
+
     def __init__(self, dirname, stat, user=None, shortdate=False):
-        ListEntry.__init__(self, dirname)
+        ListEntry.__init__(self, dirname, user=user, shortdate=shortdate)
         self.date = stat.st_mtime
         self.isspecial = (dirname in self.specialnames)
         self.isdir = True
 
-        self.fdate = formatdate(self.date, user=user, shortdate=shortdate)
-
     def __repr__(self):
         return '<DirEntry "%s">' % (self.name,)
 
@@ -182,8 +573,10 @@ class SymlinkEntry(ListEntry):
     The stat argument is the target file, unless the link is broken,
     in which case it's the link itself.
     """
+    __slots__ = ('target', 'realpath', 'realuri')
+    
     def __init__(self, filename, target, stat, isbroken=False, isdir=False, realpath=None, user=None, shortdate=False):
-        ListEntry.__init__(self, filename)
+        ListEntry.__init__(self, filename, user=user, shortdate=shortdate)
         self.target = target
         self.realpath = realpath
         self.date = stat.st_mtime
@@ -204,8 +597,6 @@ class SymlinkEntry(ListEntry):
             else:
                 self.realuri = 'arch'
 
-        self.fdate = formatdate(self.date, user=user, shortdate=shortdate)
-
     def __repr__(self):
         isbroken = ' (broken)' if self.isbroken else ''
         istype = ' (file)' if self.isfile else ' (dir)'
@@ -217,29 +608,32 @@ class IndexOnlyEntry(ListEntry):
     the file list, so we need a ListEntry class.
     (We'll pass in the date of the Index file.)
     """
+    __slots__ = ()
+    
     def __init__(self, filename, date=None, user=None, shortdate=False):
-        ListEntry.__init__(self, filename)
+        ListEntry.__init__(self, filename, user=user, shortdate=shortdate)
         self.date = date
         self.isfile = True
         self.isbroken = True
 
-        self.fdate = formatdate(self.date, user=user, shortdate=shortdate)
-
     def __repr__(self):
         return '<IndexOnlyEntry "%s">' % (self.name,)
 
 
 class UploadEntry:
     """Represents one entry in the upload log.
-    The arguments come straight from the "uploads" DB table.
+    The arguments come straight from the "uploads" DB table. (The table
+    may or may not have the later-added sha256 column at the end.)
     
     UploadEntries are used in the templates which display lists of
     upload info. Note that we don't cache these between requests; they
     are created on the fly for each request.
     """
+    __slots__ = ('uploadtime', 'md5', 'size', 'filename', 'origfilename', 'donorname', 'donoremail', 'donorip', 'donoruseragent', 'permission', 'suggestdir', 'ifdbid', 'about', 'usernotes', 'tuid', 'sha256', 'user', 'suggestdirchecked', 'suggestdiruri')
     
     def __init__(self, args, user=None):
-        (uploadtime, md5, size, filename, origfilename, donorname, donoremail, donorip, donoruseragent, permission, suggestdir, ifdbid, about, usernotes, tuid) = args
+        (uploadtime, md5, size, filename, origfilename, donorname, donoremail, donorip, donoruseragent, permission, suggestdir, ifdbid, about, usernotes, tuid) = args[ : 15 ]
+        sha256 = args[15] if len(args) > 15 else None
         self.uploadtime = uploadtime
         self.md5 = md5
         self.size = size
@@ -255,18 +649,30 @@ class UploadEntry:
         self.about = about
         self.usernotes = usernotes
         self.tuid = tuid
+        self.sha256 = sha256
 
-        self.fdate = formatdate(uploadtime, user=user, shortdate=True)
+        self.user = user
         self.suggestdirchecked = False
+        self.suggestdiruri = None
 
     def __repr__(self):
         return '<UploadEntry %s "%s">' % (self.md5, self.filename,)
+
+    @property
+    def fdate(self):
+        return formatdate(self.uploadtime, user=self.user, shortdate=True)
     
-    def checksuggested(self, app):
+    def checksuggested(self, app, cache=None):
         """Check whether the suggested directory exists.
+        If cache is supplied, it's a dict of suggestdir values we've
+        already checked. (Many upload records suggest the same directory,
+        so this saves a lot of filesystem probing in a long list.)
         """
         if self.suggestdir:
             self.suggestdirchecked = True
+            if cache is not None and self.suggestdir in cache:
+                self.suggestdiruri = cache[self.suggestdir]
+                return
             val = self.suggestdir
             if val.startswith('/'):
                 val = val[ 1 : ]
@@ -280,3 +686,5 @@ class UploadEntry:
                     self.suggestdiruri = 'arch/'+val
             except FileConsistency as ex:
                 self.suggestdiruri = None
+            if cache is not None:
+                cache[self.suggestdir] = self.suggestdiruri
@@ -0,0 +1,180 @@
+"""The admintool database schema, as a list of numbered migrations.
+
+A fresh database starts at version 0 and runs every migration in order;
+an existing one runs only those it hasn't seen. The current version is
+stored in the schema_version table.
+
+(Databases created before this module existed have tables but no
+schema_version. That's fine; the early migrations check what's already
+there before creating anything.)
+
+To change the schema, add a function to the end of MIGRATIONS. Never
+edit or reorder existing entries.
+"""
+
+def table_names(curs):
+    """Return a list of the tables in the database.
+    """
+    res = curs.execute('SELECT name FROM sqlite_master WHERE type = ?', ('table',))
+    return [ tup[0] for tup in res.fetchall() ]
+
+def table_columns(curs, table):
+    """Return a list of the column names in a table.
+    """
+    res = curs.execute('PRAGMA table_info(%s)' % (table,))
+    return [ tup[1] for tup in res.fetchall() ]
+
+def add_column(curs, table, column, log=print):
+    """Add a column to a table, unless it already exists.
+    """
+    if column in table_columns(curs, table):
+        return
+    log('adding "%s" column to "%s" table...' % (column, table,))
+    curs.execute('ALTER TABLE %s ADD COLUMN %s' % (table, column,))
+
+def create_table(curs, table, spec, log=print):
+    """Create a table, unless it already exists.
+    """
+    if table in table_names(curs):
+        log('"%s" table exists' % (table,))
+        return
+    log('creating "%s" table...' % (table,))
+    curs.execute('CREATE TABLE %s(%s)' % (table, spec,))
+
+def create_index(curs, index, spec, log=print):
+    """Create an index, unless it already exists.
+    """
+    log('creating index "%s"...' % (index,))
+    curs.execute('CREATE INDEX IF NOT EXISTS %s ON %s' % (index, spec,))
+
+def migrate_base_tables(curs, log):
+    create_table(curs, 'users', 'name unique, email unique, pw, pwsalt, roles, tzname', log=log)
+    create_table(curs, 'sessions', 'name, sessionid unique, ipaddr, starttime, refreshtime', log=log)
+    create_table(curs, 'uploads', 'uploadtime, md5, size, filename, origfilename, donorname, donoremail, donorip, donoruseragent, permission, suggestdir, ifdbid, about, usernotes, tuid', log=log)
+
+def migrate_upload_sha256(curs, log):
+    add_column(curs, 'uploads', 'sha256', log=log)
+
+def migrate_indexes(curs, log):
+    # Upload records for a file, oldest first.
+    create_index(curs, 'uploads_md5', 'uploads(md5, uploadtime)', log=log)
+    # The upload log, newest first.
+    create_index(curs, 'uploads_uploadtime', 'uploads(uploadtime)', log=log)
+    # Log out all of a user's sessions; clean out expired sessions.
+    create_index(curs, 'sessions_name', 'sessions(name)', log=log)
+    create_index(curs, 'sessions_refreshtime', 'sessions(refreshtime)', log=log)
+
+# Columns of the uploads table which are indexed for full-text search.
+FTS_COLUMNS = [ 'filename', 'origfilename', 'donorname', 'about', 'usernotes', 'suggestdir', 'tuid' ]
+
+def has_fts5(curs):
+    """Check whether this SQLite build supports full-text search.
+    """
+    res = curs.execute('PRAGMA compile_options')
+    return ('ENABLE_FTS5' in [ tup[0] for tup in res.fetchall() ])
+
+def migrate_upload_fts(curs, log):
+    if not has_fts5(curs):
+        log('SQLite was built without FTS5; upload search will not be available')
+        return
+    # An external-content FTS table: it indexes the uploads table
+    # without storing a second copy of the text. The triggers keep it
+    # in sync. The prefix index makes "foo*" queries fast.
+    cols = ', '.join(FTS_COLUMNS)
+    newcols = ', '.join([ 'new.'+col for col in FTS_COLUMNS ])
+    oldcols = ', '.join([ 'old.'+col for col in FTS_COLUMNS ])
+    log('creating "uploads_fts" table...')
+    curs.execute("CREATE VIRTUAL TABLE IF NOT EXISTS uploads_fts USING fts5(%s, content='uploads', content_rowid='rowid', prefix='2 3')" % (cols,))
+    curs.execute('CREATE TRIGGER IF NOT EXISTS uploads_fts_insert AFTER INSERT ON uploads BEGIN INSERT INTO uploads_fts(rowid, %s) VALUES (new.rowid, %s); END' % (cols, newcols,))
+    curs.execute("CREATE TRIGGER IF NOT EXISTS uploads_fts_delete AFTER DELETE ON uploads BEGIN INSERT INTO uploads_fts(uploads_fts, rowid, %s) VALUES ('delete', old.rowid, %s); END" % (cols, oldcols,))
+    curs.execute("CREATE TRIGGER IF NOT EXISTS uploads_fts_update AFTER UPDATE ON uploads BEGIN INSERT INTO uploads_fts(uploads_fts, rowid, %s) VALUES ('delete', old.rowid, %s); INSERT INTO uploads_fts(rowid, %s) VALUES (new.rowid, %s); END" % (cols, oldcols, cols, newcols,))
+    log('indexing existing uploads...')
+    curs.execute("INSERT INTO uploads_fts(uploads_fts) VALUES ('rebuild')")
+
+def migrate_catalog(curs, log):
+    # Every file in the Archive, with its md5 (see adminlib/catalog.py).
+    # The mtime is in nanoseconds.
+    create_table(curs, 'catalog', 'path unique, size, mtime, md5', log=log)
+    create_index(curs, 'catalog_md5', 'catalog(md5)', log=log)
+
+# (version, description, function) for each migration. Versions count
+# up from 1.
+MIGRATIONS = [
+    (1, 'create users, sessions, uploads tables', migrate_base_tables),
+    (2, 'add uploads.sha256', migrate_upload_sha256),
+    (3, 'add indexes on uploads and sessions', migrate_indexes),
+    (4, 'add full-text index on uploads', migrate_upload_fts),
+    (5, 'add archive file catalog', migrate_catalog),
+]
+
+def schema_version(curs):
+    """Return the current schema version (0 for a database that has
+    never been migrated).
+    """
+    if 'schema_version' not in table_names(curs):
+        return 0
+    res = curs.execute('SELECT MAX(version) FROM schema_version')
+    tup = res.fetchone()
+    return tup[0] or 0
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+def migrate(db, log=print):
+    """Bring the database up to date. Each migration runs in its own
+    transaction, along with the version bump, so a failure leaves the
+    database at the last good version.
+    (The db connection must be in autocommit mode, as AdminApp.getdb()
+    sets up.)
+    Returns the list of versions applied.
+    """
+    curs = db.cursor()
+    curs.execute('CREATE TABLE IF NOT EXISTS schema_version(version, appliedtime)')
+    curversion = schema_version(curs)
+    applied = []
+    for version, desc, func in MIGRATIONS:
+        if version <= curversion:
+            continue
+        log('migration %d: %s' % (version, desc,))
+        curs.execute('BEGIN')
+        try:
+            func(curs, log)
+            curs.execute('INSERT INTO schema_version VALUES (?, strftime(\'%s\', \'now\'))', (version,))
+            curs.execute('COMMIT')
+        except:
+            curs.execute('ROLLBACK')
+            raise
+        applied.append(version)
+    return applied
+
+# Queries which run on every page view (or close to it). "migrate --check"
+# shows how SQLite plans them, so we can confirm that they use indexes.
+# Each entry is (table, query, args); the table is named so that we can
+# skip queries on tables which a migration hasn't created yet.
+HOT_QUERIES = [
+    ('uploads', 'SELECT * FROM uploads WHERE md5 = ? ORDER BY uploadtime', ('x',)),
+    ('uploads', 'SELECT * FROM uploads WHERE md5 IN (?, ?) ORDER BY uploadtime', ('x', 'y')),
+    ('uploads', 'SELECT rowid, * FROM uploads ORDER BY uploadtime DESC, rowid DESC LIMIT ?', (20,)),
+    ('uploads', 'SELECT rowid, * FROM uploads WHERE (uploadtime, rowid) < (?, ?) ORDER BY uploadtime DESC, rowid DESC LIMIT ?', (0, 0, 20)),
+    ('uploads', 'SELECT rowid, * FROM uploads WHERE (uploadtime, rowid) > (?, ?) ORDER BY uploadtime, rowid LIMIT ?', (0, 0, 21)),
+    ('catalog', 'SELECT path, md5 FROM catalog WHERE md5 IN (?, ?)', ('x', 'y')),
+    ('sessions', 'SELECT name, starttime, refreshtime FROM sessions WHERE sessionid = ?', ('x',)),
+    ('sessions', 'SELECT sessions.name, sessions.starttime, sessions.refreshtime, users.email, users.roles, users.tzname FROM sessions JOIN users ON users.name = sessions.name WHERE sessions.sessionid = ?', ('x',)),
+    ('sessions', 'UPDATE sessions SET sessionid = ?, ipaddr = ?, refreshtime = ? WHERE sessionid = ? AND refreshtime = ?', ('x', '?', 0, 'y', 0)),
+    ('users', 'SELECT name, pw, pwsalt, roles FROM users WHERE email = ?', ('x',)),
+    ('sessions', 'DELETE FROM sessions WHERE name = ?', ('x',)),
+    ('sessions', 'DELETE FROM sessions WHERE refreshtime < ?', (0,)),
+]
+
+def explain_query(curs, query, args):
+    """Return the EXPLAIN QUERY PLAN lines for a query, and a flag which
+    is true if the plan involves a full table scan. (A temporary sort
+    is fine if it's only sorting the rows found by an index search.)
+    """
+    res = curs.execute('EXPLAIN QUERY PLAN '+query, args)
+    lines = [ tup[-1] for tup in res.fetchall() ]
+    bad = False
+    for line in lines:
+        if line.startswith('SCAN') and 'INDEX' not in line:
+            bad = True
+    return (lines, bad)
@@ -1,3 +1,7 @@
+import copy
+import threading
+import time
+
 import pytz
 
 # pytz is obsolete, but the Archive machine is still on Py3.7 so we're
@@ -6,7 +10,7 @@ import pytz
 from tinyapp.constants import PLAINTEXT, HTML
 from tinyapp.excepts import HTTPError
 from tinyapp.util import random_bytes, time_now
-from adminlib.util import in_user_time
+from adminlib.util import format_user_minute
 
 class User:
     """Represents one user of the admintool.
@@ -35,6 +39,14 @@ class User:
             except:
                 pass
 
+    def for_session(self, sessionid):
+        """Return a copy of this User with the given sessionid. (The
+        roles set and tz are shared, not copied.)
+        """
+        user = copy.copy(self)
+        user.sessionid = sessionid
+        return user
+
     def has_role(self, *roles):
         for role in roles:
             if role in self.roles:
@@ -54,19 +66,121 @@ class Session:
         self.ipaddr = ipaddr
         self.starttime = starttime
         self.refreshtime = refreshtime
-
-        mtime = in_user_time(user, starttime)
-        self.fstarttime = mtime.strftime('%b %d, %H:%M %Z')
-        mtime = in_user_time(user, refreshtime)
-        self.frefreshtime = mtime.strftime('%b %d, %H:%M %Z')
+        self.user = user
 
         self.expiretime = None
-        self.fexpiretime = None
         if maxage:
             self.expiretime = self.refreshtime + maxage
-            mtime = in_user_time(user, self.expiretime)
-            self.fexpiretime = mtime.strftime('%b %d, %H:%M %Z')
 
+    # The formatted times are computed when the template asks for them.
+    
+    @property
+    def fstarttime(self):
+        return format_user_minute(self.user, self.starttime)
+
+    @property
+    def frefreshtime(self):
+        return format_user_minute(self.user, self.refreshtime)
+
+    @property
+    def fexpiretime(self):
+        if self.expiretime is None:
+            return None
+        return format_user_minute(self.user, self.expiretime)
+
+
+class SessionCache:
+    """A short-lived in-process cache of user records, so that we don't
+    have to look up the users table on every request. Maps a sessionid
+    to a User object (with no sessionid) for that session's user.
+
+    The session itself is always checked in the database; that's one
+    indexed lookup per request, and it means that logging out (or having
+    your sessions deleted by "edituser") takes effect at once in every
+    process. The user's roles and timezone may be stale for up to ttl
+    seconds if they're changed by another process or by the CLI.
+
+    The cached User objects are shared between requests, so they must be
+    treated as read-only. Use for_session() to get a per-request copy.
+
+    This is thread-safe.
+    """
+    def __init__(self, ttl=60, maxentries=1000):
+        self.ttl = ttl
+        self.maxentries = maxentries
+        self.map = {}
+        self.lock = threading.Lock()
+        # Counters for the session list page. "requests" counts requests
+        # which arrive with a session cookie; "writes" counts writes to
+        # the sessions table (logins, logouts, refreshes).
+        self.stats = {
+            'requests': 0,
+            'hits': 0,
+            'misses': 0,
+            'writes': 0,
+            'logins': 0,
+            'logouts': 0,
+            'refreshes': 0,
+            'refreshraces': 0,
+        }
+
+    def get(self, sessionid):
+        """Return the cached User for a session, or None if we don't
+        have a fresh entry.
+        """
+        if not self.ttl:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            ent = self.map.get(sessionid)
+            if ent is not None and now - ent[0] > self.ttl:
+                del self.map[sessionid]
+                ent = None
+            if ent is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            return ent[1]
+
+    def count(self, key, val=1):
+        """Bump one of the stats counters.
+        """
+        with self.lock:
+            self.stats[key] += val
+
+    def put(self, sessionid, user):
+        if not self.ttl:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if len(self.map) >= self.maxentries:
+                # Sessions don't turn over fast enough for this to
+                # matter; just start fresh.
+                self.map.clear()
+            self.map[sessionid] = (now, user)
+
+    def invalidate_session(self, sessionid):
+        with self.lock:
+            self.map.pop(sessionid, None)
+
+    def invalidate_user(self, name):
+        """Drop a user's cached records (after they change their
+        settings).
+        """
+        with self.lock:
+            ls = [ key for key, ent in self.map.items() if ent[1].name == name ]
+            for key in ls:
+                del self.map[key]
+
+    def get_stats(self):
+        with self.lock:
+            res = dict(self.stats)
+            res['entries'] = len(self.map)
+        res['ttl'] = self.ttl
+        res['writesperrequest'] = None
+        if res['requests']:
+            res['writesperrequest'] = res['writes'] / res['requests']
+        return res
 
 def find_user(req, han):
     """Request filter which figures out which user sent the request
@@ -80,42 +194,68 @@ def find_user(req, han):
 
     (Note that this doesn't complain about unauthenticated requests. Use
     require_user() for that.)
+
+    The session row is read from the database on every request. The
+    user's record usually comes out of app.sessioncache; if not, we
+    read it in the same query.
     """
     cookiename = req.app.cookieprefix+'sessionid'
     if cookiename not in req.cookies:
         return han(req)
     
     sessionid = req.cookies[cookiename].value
+    sessioncache = req.app.sessioncache
+    sessioncache.count('requests')
     curs = req.app.getdb().cursor()
-    res = curs.execute('SELECT name, starttime, refreshtime FROM sessions WHERE sessionid = ?', (sessionid,))
-    tup = res.fetchone()
-    if not tup:
-        return han(req)
-    name, starttime, refreshtime = tup
+    cached = sessioncache.get(sessionid)
+    if cached is not None:
+        res = curs.execute('SELECT name, starttime, refreshtime FROM sessions WHERE sessionid = ?', (sessionid,))
+        tup = res.fetchone()
+        if not tup:
+            sessioncache.invalidate_session(sessionid)
+            return han(req)
+        name, starttime, refreshtime = tup
+    else:
+        res = curs.execute('SELECT sessions.name, sessions.starttime, sessions.refreshtime, users.email, users.roles, users.tzname FROM sessions JOIN users ON users.name = sessions.name WHERE sessions.sessionid = ?', (sessionid,))
+        tup = res.fetchone()
+        if not tup:
+            return han(req)
+        name, starttime, refreshtime, email, roles, tzname = tup
+        cached = User(name, email, roles=roles, tzname=tzname)
+        sessioncache.put(sessionid, cached)
 
     now = time_now()
     if now - refreshtime > req.app.max_session_age:
         # Session has expired.
+        sessioncache.invalidate_session(sessionid)
         return han(req)
+    
     if now - refreshtime > req.app.max_session_age / 2:
-        # Session is half over. Let's refresh it -- that is, delete it
-        # and create a new one.
+        # Session is half over. Let's refresh it -- that is, give it a
+        # new id and a new refresh time.
         # (Only on GET, because I don't want to stick more than one
         # hot dog in the gears at a time.)
+        # This is one UPDATE (so one transaction), guarded by the old
+        # refresh time. If two requests race to refresh the same
+        # session, only one of them matches; the other leaves the
+        # cookie alone and carries on with the session it was given.
+        # Either way there's one write per session per refresh window.
         if req.request_method == 'GET':
-            curs.execute('DELETE FROM sessions WHERE sessionid = ?', (sessionid,))
-            sessionid = random_bytes(20)
-            req.set_cookie(req.app.cookieprefix+'sessionid', sessionid, maxage=req.app.max_session_age, httponly=True)
+            newsessionid = random_bytes(20)
             ipaddr = req.env.get('REMOTE_ADDR', '?')
-            curs.execute('INSERT INTO sessions VALUES (?, ?, ?, ?, ?)', (name, sessionid, ipaddr, starttime, now))
-            req.loginfo('Refreshed login session: user=%s', name)
+            res = curs.execute('UPDATE sessions SET sessionid = ?, ipaddr = ?, refreshtime = ? WHERE sessionid = ? AND refreshtime = ?', (newsessionid, ipaddr, now, sessionid, refreshtime))
+            if res.rowcount:
+                sessioncache.count('writes')
+                sessioncache.count('refreshes')
+                sessioncache.invalidate_session(sessionid)
+                sessionid = newsessionid
+                sessioncache.put(sessionid, cached)
+                req.set_cookie(req.app.cookieprefix+'sessionid', sessionid, maxage=req.app.max_session_age, httponly=True)
+                req.loginfo('Refreshed login session: user=%s', name)
+            else:
+                sessioncache.count('refreshraces')
     
-    res = curs.execute('SELECT email, roles, tzname FROM users WHERE name = ?', (name,))
-    tup = res.fetchone()
-    if tup:
-        email, roles, tzname = tup
-        req._user = User(name, email, roles=roles, tzname=tzname, sessionid=sessionid)
-        
+    req._user = cached.for_session(sessionid)
     return han(req)
         
 def require_user(req, han):
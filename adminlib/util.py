@@ -133,6 +133,135 @@ def in_user_time(user, timestamp):
         dat = dat.astimezone(tz_utc)
     return dat
 
+# Memoized date formatting. A directory listing or upload log formats
+# hundreds of timestamps, mostly falling on a few days (or minutes), so
+# we remember the strings. The caches are keyed on the timezone and the
+# format, and are simply thrown away when they get too big. (Dict get and
+# set are atomic, so threads can share them.)
+
+DATE_CACHE_MAX = 20000
+_day_cache = {}
+_minute_cache = {}
+
+def format_user_day(user, timestamp, fmt='%b %d, %Y'):
+    """Format a timestamp in the user's timezone (or UTC), with a format
+    that only shows the date. The result is cached by calendar day.
+    """
+    tz = user.tz if (user and user.tz) else tz_utc
+    utcday = int(timestamp // 86400)
+    key = (tz, fmt, utcday)
+    ent = _day_cache.get(key)
+    if ent is None:
+        # If the UTC offset is the same all day, the UTC day overlaps at
+        # most two local days. We remember both strings, and the local
+        # midnight that separates them.
+        # If the offset changes, the local date can step back and
+        # forth (America/St_Johns used to fall back at 00:01), so we
+        # don't try; we remember that this day has to be formatted
+        # directly.
+        dat0 = in_user_time(user, utcday * 86400)
+        dat1 = in_user_time(user, utcday * 86400 + 86399)
+        if dat0.utcoffset() != dat1.utcoffset():
+            ent = (None, None, None)
+        elif dat0.date() == dat1.date():
+            ent = (None, dat0.strftime(fmt), None)
+        else:
+            # Count back from dat1 to midnight.
+            boundary = utcday * 86400 + 86399 - (dat1.hour * 3600 + dat1.minute * 60 + dat1.second)
+            ent = (boundary, dat0.strftime(fmt), dat1.strftime(fmt))
+        if len(_day_cache) >= DATE_CACHE_MAX:
+            _day_cache.clear()
+        _day_cache[key] = ent
+    boundary, val0, val1 = ent
+    if val0 is None:
+        return in_user_time(user, timestamp).strftime(fmt)
+    if boundary is not None and timestamp >= boundary:
+        return val1
+    return val0
+
+def format_user_minute(user, timestamp, fmt='%b %d, %H:%M %Z'):
+    """Format a timestamp in the user's timezone (or UTC), with a format
+    that shows no more than the minute. The result is cached by minute.
+    """
+    tz = user.tz if (user and user.tz) else tz_utc
+    key = (tz, fmt, int(timestamp // 60))
+    val = _minute_cache.get(key)
+    if val is None:
+        val = in_user_time(user, timestamp).strftime(fmt)
+        if len(_minute_cache) >= DATE_CACHE_MAX:
+            _minute_cache.clear()
+        _minute_cache[key] = val
+    return val
+
+def clear_date_caches():
+    """Forget all memoized date strings. (For benchmarking.)
+    """
+    _day_cache.clear()
+    _minute_cache.clear()
+
+def user_date_to_timestamp(user, val, nextday=False):
+    """Convert a "YYYY-MM-DD" string to a UNIX timestamp: midnight at the
+    start of that day in the user's timezone (or UTC). If nextday is
+    true, return midnight at the end of the day instead.
+    Raises ValueError if the string isn't a valid date.
+    """
+    dat = datetime.datetime.strptime(val.strip(), '%Y-%m-%d')
+    if nextday:
+        dat = dat + datetime.timedelta(days=1)
+    if user and user.tz:
+        dat = user.tz.localize(dat)
+    else:
+        dat = tz_utc.localize(dat)
+    return int(dat.timestamp())
+
+# Older SQLite builds allow at most 999 "?" parameters per statement.
+# We stay well under that.
+SQL_CHUNK_SIZE = 500
+
+def sql_chunks(ls, size=SQL_CHUNK_SIZE):
+    """Split a list into chunks small enough for a "WHERE x IN (...)"
+    query. Yields (chunk, placeholders) pairs, where placeholders is
+    the "?, ?, ?" string to go in the parentheses.
+    """
+    for pos in range(0, len(ls), size):
+        chunk = ls[ pos : pos+size ]
+        yield (chunk, ', '.join('?' * len(chunk)))
+
+def fts_query(val):
+    """Turn a user's search string into an FTS5 MATCH expression. Each
+    word becomes a quoted prefix term, so punctuation in the input can't
+    cause a syntax error, and "zork" finds "zork1" and "zorkmid". All
+    the words must match.
+    Returns None if there are no words.
+    """
+    words = val.split()
+    if not words:
+        return None
+    return ' '.join([ '"%s"*' % (word.replace('"', '""'),) for word in words ])
+
+# Markers that surround matched text in FTS5 snippets. We split on these
+# in split_snippet() so that the template can escape the text normally.
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+
+def split_snippet(val):
+    """Split an FTS5 snippet (made with SNIPPET_START and SNIPPET_END
+    markers) into a list of (text, ismatch) pairs.
+    """
+    res = []
+    if not val:
+        return res
+    for seg in val.split(SNIPPET_START):
+        hit, sep, rest = seg.partition(SNIPPET_END)
+        if sep:
+            if hit:
+                res.append( (hit, True) )
+        else:
+            rest = hit
+        if rest:
+            res.append( (rest, False) )
+    return res
+
 def urlencode(val):
     """Percent-encode an URL (or part thereof). This should be compatible
     with the Jinja |urlencode filter, although I haven't completely verified
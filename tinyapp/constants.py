@@ -2,4 +2,6 @@
 BINARY = 'application/octet-stream'
 PLAINTEXT = 'text/plain; charset=utf-8'
 HTML = 'text/html; charset=utf-8'
-
+JSON = 'application/json; charset=utf-8'
+CSV = 'text/csv; charset=utf-8'
+JSONLINES = 'application/x-ndjson; charset=utf-8'